@@ -101,6 +101,65 @@ def cmd_GAME_STATE_COMPLETE(game):
     game.tui.to_update['inventory'] = True
 
 
+def apply_gamestate_fields(game, inventory, things):
+    """Apply inventory and thing entries fields of game state frame/delta."""
+    if things != ',':
+        for entry in things.split(','):
+            id_, type_, y, x, health = entry.split(':')
+            t = game.get_thing(int(id_))
+            t.type_ = type_
+            t.position = YX(0,0), YX(int(y), int(x))
+            if health != '':
+                t.health = int(health)
+    if inventory == ',':
+        game.player_inventory[:] = []
+    elif inventory != '=':
+        game.player_inventory[:] = [int(i) for i in inventory.split(',')]
+
+
+def cmd_GAME_STATE(game, frame):
+    """Apply frame of 'GAME_STATE' message, see server's get_gamestate_frame."""
+    try:
+        turn, size, indent, inventory, things, terrain = frame.split(' ', 5)
+        size = game.parser.parse_yx_tuple(size, 'pos')
+        game.turn = int(turn)
+        game.new_map(size, indent == 'True')
+        if len(terrain) != game.map_.size_i:
+            raise ArgError('Terrain does not fit map size.')
+        game.map_.terrain = bytearray(terrain.encode())
+        game.things = []
+        game.pickable_items[:] = []
+        apply_gamestate_fields(game, inventory, things)
+    except ValueError:
+        raise ArgError('Malformed game state frame.')
+    cmd_GAME_STATE_COMPLETE(game)
+
+
+def cmd_GAME_STATE_DELTA(game, delta):
+    """Apply 'GAME_STATE_DELTA' message, see server's get_gamestate_delta."""
+    try:
+        turn, inventory, things, gone, rows, terrain = delta.split(' ', 5)
+        width = game.map_.size.x
+        rows = [] if rows == ',' else [int(y) for y in rows.split(',')]
+        if len(terrain) != len(rows) * width or \
+           (rows and max(rows) >= game.map_.size.y):
+            raise ArgError('Terrain does not fit map size.')
+        game.turn = int(turn)
+        for i, y in enumerate(rows):
+            game.map_.set_row_slice(y, 0, terrain[i * width:(i + 1) * width]
+                                    .encode())
+        if gone != ',':
+            for id_ in gone.split(','):
+                t = game.get_thing(int(id_), False)
+                if t is not None:
+                    game.remove_thing(t)
+        game.pickable_items[:] = []
+        apply_gamestate_fields(game, inventory, things)
+    except ValueError:
+        raise ArgError('Malformed game state delta.')
+    cmd_GAME_STATE_COMPLETE(game)
+
+
 def cmd_THING_TYPE(game, i, type_):
     t = game.get_thing(i)
     t.type_ = type_
@@ -178,6 +237,13 @@ class Game(GameBase):
             self.do_quit = True
             return
         try:
+            # Skip the tokenizer for these; they are split in one go.
+            if msg.startswith('GAME_STATE '):
+                cmd_GAME_STATE(self, msg[len('GAME_STATE '):])
+                return
+            if msg.startswith('GAME_STATE_DELTA '):
+                cmd_GAME_STATE_DELTA(self, msg[len('GAME_STATE_DELTA '):])
+                return
             command, args = self.parser.parse(msg)
             if command is None:
                 self.log('UNHANDLED INPUT: ' + msg)
@@ -321,9 +387,7 @@ class DescriptorWidget(TextLinesWidget):
 
     def get_text_lines(self):
         lines = []
-        pos_i = self.tui.game.map_.\
-                get_position_index(self.tui.examiner_position[1])
-        terrain = self.tui.game.map_.terrain[pos_i]
+        terrain = self.tui.game.map_[self.tui.examiner_position[1]]
         lines = [terrain]
         for t in self.tui.game.things_at_pos(self.tui.examiner_position):
             lines += [t.type_]
@@ -387,7 +451,7 @@ class MapWidget(Widget):
     def draw(self):
 
         def annotated_terrain():
-            terrain_as_list = list(self.tui.game.map_.terrain[:])
+            terrain_as_list = list(self.tui.game.map_.terrain.decode())
             for t in self.tui.game.things:
                 if t.id_ in self.tui.game.player_inventory:
                     continue
@@ -438,7 +502,7 @@ class MapWidget(Widget):
                     chars_with_attrs += [c]
             return chars_with_attrs
 
-        if self.tui.game.map_.terrain == '':
+        if len(self.tui.game.map_.terrain) == 0:
             lines = []
             pad_y(lines)
             self.safe_write(''.join(lines))
@@ -671,6 +735,7 @@ class TUI:
         # Ensure initial window state before loop starts.
         for w in top_widgets:
             w.ensure_freshness(True)
+        self.socket.send('GAMESTATE_MODE delta')
         self.socket.send('GET_GAMESTATE')
         write_mode = False
         while True:
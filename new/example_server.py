@@ -2,22 +2,29 @@
 import sys
 import os
 from plomrogue.game import Game
+from plomrogue.replay import Replay
 
-if len(sys.argv) != 2:
-    print('wrong number of arguments, expected one (game file)')
+if len(sys.argv) not in {2, 3, 4}:
+    print('wrong number of arguments, expected game file, optionally '
+          'followed by journal durability (none, flush, fsync) and its '
+          'sync interval in seconds')
     exit(1)
 game_file_name = sys.argv[1]
-game = Game(game_file_name)
+journal_options = {}
+if len(sys.argv) > 2:
+    journal_options['durability'] = sys.argv[2]
+if len(sys.argv) > 3:
+    journal_options['sync_interval'] = float(sys.argv[3])
+game = Game(game_file_name, journal_options=journal_options)
 if os.path.exists(game_file_name):
     if not os.path.isfile(game_file_name):
         print('game file name does not refer to a valid game file')
     else:
-        with open(game_file_name, 'r') as f:
-            lines = f.readlines()
-        for i in range(len(lines)):
-            line = lines[i]
-            print("FILE INPUT LINE %5s: %s" % (i, line), end='')
-            game.io.handle_input(line, store=False)
+        replay = Replay(game)
+        n_lines = replay.run_file(game_file_name)
+        print(replay.get_stats())
+        if n_lines > game.io.snapshot_interval:
+            game.io.compact()
 else:
     game.io.handle_input('GEN_WORLD Y:16,X:16 42')
 game.io.run_loop_with_server()
@@ -1,4 +1,8 @@
+import os
+from plomrogue.errors import ArgError, GameError
 from plomrogue.misc import quote
+from plomrogue import snapshot
+from plomrogue.replay import get_restorer
 
 
 
@@ -10,6 +14,16 @@ def cmd_GET_GAMESTATE(game, connection_id):
     """Send game state to caller."""
     game.send_gamestate(connection_id)
 
+def cmd_GAMESTATE_MODE(game, mode, connection_id):
+    """Set in what form caller receives game states, see send_gamestate()."""
+    game.io.gamestate_modes[connection_id] = mode
+    game.io.sent_gamestates.pop(connection_id, None)
+cmd_GAMESTATE_MODE.argtypes = 'string:gamestate_mode'
+
+def cmd_GET_JOURNAL_STATS(game, connection_id):
+    """Send game file journal's commit statistics to caller."""
+    game.io.send(game.io.journal.get_stats(), connection_id)
+
 def cmd_SEED(game, seed):
     game.rand.prngod_seed = seed
 cmd_SEED.argtypes = 'int:nonneg'
@@ -41,8 +55,7 @@ def cmd_THING_TYPE(game, i, type_):
     #    setattr(t_new, attr_name, attr_old)
     t_new.position = t_old.position
     t_new.in_inventory = t_old.in_inventory
-    t_old_index = game.things.index(t_old)
-    game.things[t_old_index] = t_new
+    game.replace_thing(t_old, t_new)
 cmd_THING_TYPE.argtypes = 'int:nonneg string:thingtype'
 
 def cmd_THING_POS(game, i, big_yx, small_yx):
@@ -65,20 +78,26 @@ def cmd_THING_HEALTH(game, id_, health):
 cmd_THING_HEALTH.argtypes = 'int:nonneg int:nonneg'
 
 def cmd_GET_PICKABLE_ITEMS(game, connection_id):
+    """Send IDs of things the player could pick up to caller."""
     pickable_ids = game.player.get_pickable_items()
     if len(pickable_ids) > 0:
         game.io.send('PICKABLE_ITEMS %s' %
-                     ','.join([str(id_) for id_ in pickable_ids]))
+                     ','.join([str(id_) for id_ in pickable_ids]),
+                     connection_id)
     else:
-        game.io.send('PICKABLE_ITEMS ,')
+        game.io.send('PICKABLE_ITEMS ,', connection_id)
 
 def cmd_TERRAIN_LINE(game, big_yx, y, terrain_line):
     game.maps[big_yx].set_line(y, terrain_line)
+    game.spawn_cells.pop(big_yx, None)
 cmd_TERRAIN_LINE.argtypes = 'yx_tuple int:nonneg string'
 
 def cmd_PLAYER_ID(game, id_):
     # TODO: test whether valid thing ID
     game.player_id = id_
+    # Saves set the player's health before, so catch up on its death.
+    player = game.get_thing(id_, False)
+    game.player_is_alive = getattr(player, 'health', 1) > 0
 cmd_PLAYER_ID.argtypes = 'int:nonneg'
 
 def cmd_TURN(game, n):
@@ -95,39 +114,78 @@ def cmd_SWITCH_PLAYER(game):
         game.player_id = thing_ids[player_index + 1]
     game.proceed()
 
-def cmd_SAVE(game):
+def cmd_LOAD_SNAPSHOT(game, file_name, connection_id):
+    """Load game state from snapshot file_name, written by GameIO.compact().
+
+    Only for use in the game file, and only for its own snapshots,
+    which are found in the same directory.
+
+    """
+    if connection_id is not None:
+        raise GameError('Snapshots can only be loaded from the game file.')
+    prefix = os.path.basename(game.io.game_file_name) + '.snapshot.'
+    number = file_name[len(prefix):]
+    if file_name[:len(prefix)] != prefix or not number.isdigit():
+        raise ArgError('Not a snapshot of this game: %s' % file_name)
+    directory = os.path.dirname(game.io.game_file_name)
+    snapshot.read(game, os.path.join(directory, file_name))
+    game.io.snapshot_number = int(number)
+cmd_LOAD_SNAPSHOT.argtypes = 'string'
+
+def cmd_REPLAY_TO(game, turn, connection_id):
+    """Write save of latest indexed state up to turn, see get_restorer().
+
+    Like cmd_SAVE, but to game file name plus '.turn_' plus turn plus
+    '.save', and with the state restored and replayed in the
+    background, too. When done, caller is sent 'REPLAYED_TO' plus the
+    turn restored and the file name, and the replay's stats. Only one
+    such replay may run at a time.
+
+    """
+    prefix = game.io.game_file_name + '.turn_'
+    if game.io.is_writing(prefix):
+        raise GameError('Already replaying.')
+    save_file_name = '%s%s.save' % (prefix, turn)
+    restore = get_restorer(game, turn)
+    restored = []
+
+    def get_data():
+        restored[:] = restore()
+        return ''.join([line + '\n'
+                        for line in restored[0].get_save_lines()])
+
+    def done(error):
+        if error is None:
+            game.io.send('REPLAYED_TO %s %s' % (restored[0].turn,
+                                                quote(save_file_name)),
+                         connection_id)
+            game.io.send(restored[1].get_stats(), connection_id)
+        else:
+            game.io.send('GAME_ERROR ' + quote('Replay failed: ' + error),
+                         connection_id)
+
+    game.io.write_in_background(save_file_name, get_data, done)
+cmd_REPLAY_TO.argtypes = 'int:nonneg'
+
+def cmd_SAVE(game, connection_id):
+    """Write commands rebuilding game state to game file name plus '.save'.
+
+    The game state is captured right away, but the file is written in
+    the background (see GameIO.write_in_background()). When it is
+    done, caller is sent 'SAVED' plus the file name, or a GAME_ERROR.
+
+    """
+    save_file_name = game.io.game_file_name + '.save'
+    state = game.get_save_state()
 
-    def write(f, msg):
-        f.write(msg + '\n')
+    def get_data():
+        return ''.join([line + '\n' for line in game.get_save_lines(state)])
 
-    save_file_name = game.io.game_file_name + '.save'
-    with open(save_file_name, 'w') as f:
-        write(f, 'TURN %s' % game.turn)
-        write(f, 'SEED %s' % game.rand.prngod_seed)
-        write(f, 'MAP_SIZE %s' % (game.map_size,))
-        for map_pos in game.maps:
-            write(f, 'MAP %s' % (map_pos,))
-        for map_pos in game.maps:
-            for y, line in game.maps[map_pos].lines():
-                 write(f, 'TERRAIN_LINE %s %5s %s' % (map_pos, y, quote(line)))
-        for thing in game.things:
-            write(f, 'THING_TYPE %s %s' % (thing.id_, thing.type_))
-            write(f, 'THING_POS %s %s %s' % (thing.id_, thing.position[0],
-                                             thing.position[1]))
-            if hasattr(thing, 'health'):
-                write(f, 'THING_HEALTH %s %s' % (thing.id_, thing.health))
-            if len(thing.inventory) > 0:
-                write(f, 'THING_INVENTORY %s %s' %
-                      (thing.id_,','.join([str(i) for i in thing.inventory])))
-            else:
-                write(f, 'THING_INVENTORY %s ,' % thing.id_)
-            if hasattr(thing, 'task'):
-                task = thing.task
-                if task is not None:
-                    task_args = task.get_args_string()
-                    task_name = [k for k in game.tasks.keys()
-                                 if game.tasks[k] == task.__class__][0]
-                    write(f, 'SET_TASK:%s %s %s %s' % (task_name, thing.id_,
-                                                       task.todo, task_args))
-        write(f, 'PLAYER_ID %s' % game.player_id)
-cmd_SAVE.dont_save = True
+    def done(error):
+        if error is None:
+            game.io.send('SAVED ' + quote(save_file_name), connection_id)
+        else:
+            game.io.send('GAME_ERROR ' + quote('Save failed: ' + error),
+                         connection_id)
+
+    game.io.write_in_background(save_file_name, get_data, done)
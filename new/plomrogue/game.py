@@ -7,13 +7,31 @@ from plomrogue.commands import (cmd_GEN_WORLD, cmd_GET_GAMESTATE,
                                 cmd_THING_HEALTH, cmd_SEED,
                                 cmd_GET_PICKABLE_ITEMS, cmd_MAP_SIZE,
                                 cmd_TERRAIN_LINE, cmd_PLAYER_ID,
-                                cmd_TURN, cmd_SWITCH_PLAYER, cmd_SAVE)
+                                cmd_TURN, cmd_SWITCH_PLAYER, cmd_SAVE,
+                                cmd_GAMESTATE_MODE, cmd_GET_JOURNAL_STATS,
+                                cmd_LOAD_SNAPSHOT, cmd_REPLAY_TO)
 from plomrogue.mapping import MapGeometryHex, Map, YX
 from plomrogue.parser import Parser
 from plomrogue.io import GameIO
 from plomrogue.misc import quote
-from plomrogue.things import Thing, ThingMonster, ThingHuman, ThingFood
+from plomrogue.things import (Thing, ThingAnimate, ThingMonster, ThingHuman,
+                              ThingFood)
+import bisect
+import collections
+import math
+import os
 import random
+import tempfile
+import unittest
+
+
+
+GameStateView = collections.namedtuple('GameStateView',
+                                       ('turn', 'size', 'start_indented',
+                                        'terrain', 'things', 'inventory'))
+SaveState = collections.namedtuple('SaveState',
+                                   ('turn', 'seed', 'map_size', 'terrains',
+                                    'things', 'player_id'))
 
 
 
@@ -40,30 +58,124 @@ class GameBase:
         self.turn = 0
         self.things = []
 
+    @property
+    def things(self):
+        """Return list of world things, in world order.
+
+        Things are stored in the dict ._things_by_id, mapping their IDs
+        to them in insertion order, for O(1) lookup and removal.
+
+        """
+        return list(self._things_by_id.values())
+
+    @things.setter
+    def things(self, things):
+        """Set list of world things, (re-)build index of their positions."""
+        self._things_by_id = {}
+        self._turn_order = None
+        self.things_by_pos = {}
+        self.things_by_map = {}
+        for thing in things:
+            self.add_thing(thing)
+
+    def add_thing(self, thing):
+        if self._turn_order is not None:
+            if thing.id_ in self._things_by_id:
+                self._turn_order = None
+            else:
+                self._turn_order[1].append(thing)
+        self._things_by_id[thing.id_] = thing
+        self._index_thing(thing, thing.position)
+
+    def remove_thing(self, thing):
+        del self._things_by_id[thing.id_]
+        self._turn_order = None
+        self._unindex_thing(thing, thing.position)
+
+    def replace_thing(self, old_thing, new_thing):
+        """Put new_thing of same ID into old_thing's place in world order."""
+        self._things_by_id[old_thing.id_] = new_thing
+        self._turn_order = None
+        self._unindex_thing(old_thing, old_thing.position)
+        self._index_thing(new_thing, new_thing.position)
+
+    def get_turn_order(self):
+        """Return list of things in world order and the player's index.
+
+        The list is kept as long as things are only added (which
+        appends them to it), so that the player's index need not be
+        searched anew every turn. Removing or replacing things, or
+        switching the player, rebuilds it on the next call. Callers
+        must not change it.
+
+        """
+        if self._turn_order is None or \
+           self._turn_order[0] != self.player_id:
+            player = self.player
+            things = list(self._things_by_id.values())
+            self._turn_order = (self.player_id, things, things.index(player))
+        return self._turn_order[1:]
+
+    def _index_thing(self, thing, pos, index_map=True):
+        """Add thing to position (and unless not index_map, chunk) index.
+
+        Each index maps keys to dicts of things by ID, so that moving
+        a thing in or out of one is O(1) however many it holds, and
+        these iterate in the order things entered them.
+
+        """
+        self.things_by_pos.setdefault(pos, {})[thing.id_] = thing
+        if index_map:
+            self.things_by_map.setdefault(pos[0], {})[thing.id_] = thing
+
+    def _unindex_thing(self, thing, pos, index_map=True):
+        indexes = ((self.things_by_pos, pos), (self.things_by_map, pos[0]))
+        for index, key in indexes if index_map else indexes[:1]:
+            things = index[key]
+            del things[thing.id_]
+            if len(things) == 0:
+                del index[key]
+
+    def thing_moved(self, thing, old_pos):
+        """Update position index on thing having moved from old_pos.
+
+        Ignores things not (yet) in the world things list, identified
+        by not being indexed at old_pos. Only touches the chunk index
+        if thing has left its chunk.
+
+        """
+        if old_pos in self.things_by_pos and \
+           self.things_by_pos[old_pos].get(thing.id_) is thing:
+            index_map = old_pos[0] != thing.position[0]
+            self._unindex_thing(thing, old_pos, index_map)
+            self._index_thing(thing, thing.position, index_map)
+
     def get_thing(self, id_, create_unfound=True):
-        for thing in self.things:
-            if id_ == thing.id_:
-                return thing
+        if id_ in self._things_by_id:
+            return self._things_by_id[id_]
         if create_unfound:
             t = self.thing_type(self, id_)
-            self.things += [t]
+            self.add_thing(t)
             return t
         return None
 
     def things_at_pos(self, pos):
-        things = []
-        for t in self.things:
-            if t.position == pos:
-                things += [t]
-        return things
+        return list(self.things_by_pos.get(pos, {}).values())
+
+    def blocking_thing_at(self, pos):
+        """Return a blocking thing at pos, or None if there is none."""
+        for t in self.things_by_pos.get(pos, {}).values():
+            if t.blocking:
+                return t
+        return None
 
 
 
 class Game(GameBase):
 
-    def __init__(self, game_file_name, *args, **kwargs):
+    def __init__(self, game_file_name, *args, journal_options=None, **kwargs):
         super().__init__(*args, **kwargs)
-        self.io = GameIO(game_file_name, self)
+        self.io = GameIO(game_file_name, self, **(journal_options or {}))
         self.map_size = None
         self.map_geometry = MapGeometryHex()
         self.tasks = {'WAIT': Task_WAIT,
@@ -73,6 +185,8 @@ class Game(GameBase):
                       'DROP': Task_DROP}
         self.commands = {'GEN_WORLD': cmd_GEN_WORLD,
                          'GET_GAMESTATE': cmd_GET_GAMESTATE,
+                         'GAMESTATE_MODE': cmd_GAMESTATE_MODE,
+                         'GET_JOURNAL_STATS': cmd_GET_JOURNAL_STATS,
                          'SEED': cmd_SEED,
                          'MAP_SIZE': cmd_MAP_SIZE,
                          'MAP': cmd_MAP,
@@ -85,7 +199,9 @@ class Game(GameBase):
                          'PLAYER_ID': cmd_PLAYER_ID,
                          'TURN': cmd_TURN,
                          'SWITCH_PLAYER': cmd_SWITCH_PLAYER,
-                         'SAVE': cmd_SAVE}
+                         'SAVE': cmd_SAVE,
+                         'LOAD_SNAPSHOT': cmd_LOAD_SNAPSHOT,
+                         'REPLAY_TO': cmd_REPLAY_TO}
         self.thing_type = Thing
         self.thing_types = {'human': ThingHuman,
                             'monster': ThingMonster,
@@ -94,45 +210,234 @@ class Game(GameBase):
         self.player_is_alive = True
         self.maps = {}
         self.rand = PRNGod(0)
+        self.flow_field_goals = {
+            'food': lambda t: t.type_ == 'food' and not t.in_inventory,
+            'human': lambda t: t.type_ == 'human'}
+        self.flow_fields = {}
+        self.flow_field_max_cells = 128 * 128
+        self.spawn_cells = {}
+        self.food_spawn_chance = 0.001
+        self.food_max_per_map = 32
 
     def get_string_options(self, string_option_type):
         if string_option_type == 'direction':
-            return self.map_geometry.get_directions()
+            return list(self.map_geometry.directions)
         elif string_option_type == 'thingtype':
             return list(self.thing_types.keys())
+        elif string_option_type == 'gamestate_mode':
+            return ['lines', 'frame', 'delta']
         return None
 
     def send_gamestate(self, connection_id=None):
-        """Send out game state data relevant to clients."""
+        """Send out game state data relevant to clients.
+
+        Clients get it in the gamestate mode they chose: either as
+        the classic sequence of one message per map line and thing
+        detail ('lines'), as a single frame ('frame', see
+        get_gamestate_frame()), or as the difference to the game state
+        last sent to them ('delta', see get_gamestate_delta()). Delta
+        receivers get a full frame instead if they explicitly asked
+        for the game state via connection_id, or when there is nothing
+        to compare against. Nothing is computed for modes without
+        receivers.
+
+        """
 
         def send_thing(thing):
             view_pos = self.map_geometry.pos_in_view(thing.position,
                                                      self.player.view_offset,
                                                      self.map_size)
-            self.io.send('THING_TYPE %s %s' % (thing.id_, thing.type_))
-            self.io.send('THING_POS %s %s' % (thing.id_, view_pos))
-
-        self.io.send('TURN ' + str(self.turn))
+            send('THING_TYPE %s %s' % (thing.id_, thing.type_))
+            send('THING_POS %s %s' % (thing.id_, view_pos))
+
+        def send(msg):
+            self.io.send_to(msg, lines_receivers, True)
+
+        frame_receivers = self.io.get_receivers(connection_id, 'frame')
+        delta_receivers = self.io.get_receivers(connection_id, 'delta')
+        if frame_receivers or delta_receivers:
+            state = self.get_gamestate_view()
+            # Receivers that got the same last state share a delta.
+            delta_groups = {}
+            for receiver in delta_receivers:
+                last_state = self.io.sent_gamestates.get(receiver)
+                self.io.sent_gamestates[receiver] = state
+                if connection_id is None and last_state is not None and \
+                   last_state.size == state.size and \
+                   last_state.start_indented == state.start_indented:
+                    delta_groups.setdefault(id(last_state),
+                                            (last_state, []))[1].append(receiver)
+                else:
+                    frame_receivers += [receiver]
+            for last_state, receivers in delta_groups.values():
+                self.io.send_to(self.get_gamestate_delta(last_state, state),
+                                receivers, True)
+            if frame_receivers:
+                self.io.send_to(self.get_gamestate_frame(state),
+                                frame_receivers, True)
+        lines_receivers = self.io.get_receivers(connection_id, 'lines')
+        if not lines_receivers:
+            return
+        send('TURN ' + str(self.turn))
         visible_map = self.player.get_visible_map()
-        self.io.send('VISIBLE_MAP %s %s' % (visible_map.size,
-                                            visible_map.start_indented))
+        send('VISIBLE_MAP %s %s' % (visible_map.size,
+                                    visible_map.start_indented))
         for y, line in visible_map.lines():
-            self.io.send('VISIBLE_MAP_LINE %5s %s' % (y, quote(line)))
+            send('VISIBLE_MAP_LINE %5s %s' % (y, quote(line)))
         visible_things = self.player.get_visible_things()
         for thing in visible_things:
             send_thing(thing)
             if hasattr(thing, 'health'):
-                self.io.send('THING_HEALTH %s %s' % (thing.id_,
-                                                     thing.health))
+                send('THING_HEALTH %s %s' % (thing.id_, thing.health))
         if len(self.player.inventory) > 0:
-            self.io.send('PLAYER_INVENTORY %s' %
-                         ','.join([str(i) for i in self.player.inventory]))
+            send('PLAYER_INVENTORY %s' %
+                 ','.join([str(i) for i in self.player.inventory]))
         else:
-            self.io.send('PLAYER_INVENTORY ,')
+            send('PLAYER_INVENTORY ,')
         for id_ in self.player.inventory:
             thing = self.get_thing(id_)
             send_thing(thing)
-        self.io.send('GAME_STATE_COMPLETE')
+        send('GAME_STATE_COMPLETE')
+
+    def get_gamestate_view(self):
+        """Return game state as seen by player, as a GameStateView.
+
+        Things are described by 'id:type:y:x:health' entries with y
+        and x in view coordinates and health empty where a thing has
+        none; these include the visible things as well as the ones
+        carried by the player.
+
+        """
+        visible_map = self.player.get_visible_map()
+        things = self.player.get_visible_things()
+        things += [self.get_thing(id_) for id_ in self.player.inventory]
+        thing_entries = {}
+        for thing in things:
+            view_pos = self.map_geometry.pos_in_view(thing.position,
+                                                     self.player.view_offset,
+                                                     self.map_size)
+            thing_entries[thing.id_] = '%s:%s:%s:%s:%s' % \
+                (thing.id_, thing.type_, view_pos.y, view_pos.x,
+                 getattr(thing, 'health', ''))
+        inventory = ','.join([str(i) for i in self.player.inventory])
+        return GameStateView(self.turn, visible_map.size,
+                             visible_map.start_indented,
+                             bytes(visible_map.terrain), thing_entries,
+                             inventory or ',')
+
+    def get_gamestate_frame(self, state=None):
+        """Return game state as one 'GAME_STATE' message.
+
+        Its space-separated fields are the turn, the visible map's
+        size and start_indented, the player's inventory IDs (or ','
+        for none), the entries of state.things (or ',' for none), and
+        finally the visible map's terrain rows concatenated. The
+        terrain may itself contain spaces, so it must stay last; as
+        none of the fields before needs quoting, a client can take
+        the frame apart with a single str.split(' ', 6).
+
+        """
+        if state is None:
+            state = self.get_gamestate_view()
+        return 'GAME_STATE %s %s %s %s %s %s' % (
+            state.turn, state.size, state.start_indented, state.inventory,
+            ','.join(state.things.values()) or ',', state.terrain.decode())
+
+    def get_gamestate_delta(self, last_state, state):
+        """Return 'GAME_STATE_DELTA' message updating last_state to state.
+
+        Both states must share their map size. The message's
+        space-separated fields are the turn, the player's inventory
+        IDs (or ',' for none, or '=' if unchanged), the thing entries
+        new or changed since last_state (or ','), the IDs of things
+        gone since last_state (or ','), the indices of the map rows
+        changed (or ','), and finally the terrain of those rows
+        concatenated, which must again stay last.
+
+        """
+        inventory = state.inventory
+        if inventory == last_state.inventory:
+            inventory = '='
+        things = [entry for id_, entry in state.things.items()
+                  if last_state.things.get(id_) != entry]
+        gone = [str(id_) for id_ in last_state.things
+                if id_ not in state.things]
+        width = state.size.x
+        rows = []
+        terrain = []
+        for start in range(0, len(state.terrain), width):
+            row = state.terrain[start:start + width]
+            if row != last_state.terrain[start:start + width]:
+                rows += [str(start // width)]
+                terrain += [row.decode()]
+        return 'GAME_STATE_DELTA %s %s %s %s %s %s' % (
+            state.turn, inventory, ','.join(things) or ',',
+            ','.join(gone) or ',', ','.join(rows) or ',', ''.join(terrain))
+
+    def get_save_state(self):
+        """Return point-in-time copy of game state as a SaveState.
+
+        This only copies what get_save_lines() needs, and no more
+        formatting is done than necessary, so it is cheap enough to
+        call from the game loop while the lines are built elsewhere.
+        terrains is a tuple of (map position, terrain bytes) pairs,
+        things a tuple of (ID, type, position, health or None,
+        inventory, task) tuples, with task either None or a tuple of
+        task name, todo and task arguments string.
+
+        """
+        task_names = {task_class: name for name, task_class
+                      in self.tasks.items()}
+        terrains = tuple([(map_pos, bytes(map_.terrain))
+                          for map_pos, map_ in self.maps.items()])
+        things = []
+        for thing in self._things_by_id.values():
+            task = getattr(thing, 'task', None)
+            if task is not None:
+                task = (task_names[task.__class__], task.todo,
+                        task.get_args_string())
+            things += [(thing.id_, thing.type_, thing.position,
+                        getattr(thing, 'health', None),
+                        tuple(thing.inventory), task)]
+        return SaveState(self.turn, self.rand.prngod_seed, self.map_size,
+                         terrains, tuple(things), self.player_id)
+
+    def get_save_lines(self, state=None):
+        """Return list of commands that rebuild game state.
+
+        If state is not given, it is the current get_save_state(). As
+        only state is read, this may run outside the game loop.
+
+        """
+        if state is None:
+            state = self.get_save_state()
+        lines = []
+        lines += ['TURN %s' % state.turn]
+        lines += ['SEED %s' % state.seed]
+        lines += ['MAP_SIZE %s' % (state.map_size,)]
+        for map_pos, _ in state.terrains:
+            lines += ['MAP %s' % (map_pos,)]
+        width = state.map_size.x
+        for map_pos, terrain in state.terrains:
+            for y in range(state.map_size.y):
+                line = terrain[y * width:(y + 1) * width].decode()
+                lines += ['TERRAIN_LINE %s %5s %s' % (map_pos, y, quote(line))]
+        for id_, type_, position, health, inventory, task in state.things:
+            lines += ['THING_TYPE %s %s' % (id_, type_)]
+            lines += ['THING_POS %s %s %s' % (id_, position[0], position[1])]
+            if health is not None:
+                lines += ['THING_HEALTH %s %s' % (id_, health)]
+            if len(inventory) > 0:
+                lines += ['THING_INVENTORY %s %s' %
+                          (id_, ','.join([str(i) for i in inventory]))]
+            else:
+                lines += ['THING_INVENTORY %s ,' % id_]
+            if task is not None:
+                task_name, todo, task_args = task
+                lines += ['SET_TASK:%s %s %s %s' % (task_name, id_, todo,
+                                                    task_args)]
+        lines += ['PLAYER_ID %s' % state.player_id]
+        return lines
 
     def proceed(self):
         """Send turn finish signal, run game world, send new world data.
@@ -199,21 +504,249 @@ class Game(GameBase):
         return self.get_thing(self.player_id)
 
     def new_thing_id(self):
-        if len(self.things) == 0:
+        if len(self._things_by_id) == 0:
             return 0
-        return self.things[-1].id_ + 1
+        return next(reversed(self._things_by_id.values())).id_ + 1
 
     def get_map(self, map_pos, create_unfound=True):
         if not (map_pos in self.maps and
                 self.maps[map_pos].size == self.map_size):
             if create_unfound:
                 self.maps[map_pos] = Map(self.map_size)
-                for pos in self.maps[map_pos]:
-                    self.maps[map_pos][pos] = '.'
+                self.maps[map_pos].fill('.')
+                self.spawn_cells.pop(map_pos, None)
             else:
                 return None
         return self.maps[map_pos]
 
+    def get_flow_regions(self):
+        """Return (offset, size) of regions around groups of AI things.
+
+        AI things are all animate things but the player. The maps
+        (chunks) that their views overlap are grouped wherever they
+        touch, if only diagonally, and each group's bounding rectangle
+        of chunks makes one region. So AI things far apart get regions
+        of their own rather than one spanning the space between them.
+
+        """
+        chunks = set()
+        for t in self._things_by_id.values():
+            if not isinstance(t, ThingAnimate) or t.id_ == self.player_id:
+                continue
+            start = t.view_offset
+            end = start + YX(t._radius * 2 + 1, t._radius * 2 + 1)
+            for big_y in range(start.y // self.map_size.y,
+                               (end.y - 1) // self.map_size.y + 1):
+                for big_x in range(start.x // self.map_size.x,
+                                   (end.x - 1) // self.map_size.x + 1):
+                    chunks.add(YX(big_y, big_x))
+        regions = []
+        while len(chunks) > 0:
+            group = [min(chunks)]
+            chunks.remove(group[0])
+            for big_yx in group:  # Iterates into what's appended meanwhile.
+                for dy in (-1, 0, 1):
+                    for dx in (-1, 0, 1):
+                        neighbor = YX(big_yx.y + dy, big_yx.x + dx)
+                        if neighbor in chunks:
+                            chunks.remove(neighbor)
+                            group += [neighbor]
+            big_start = YX(min([big_yx.y for big_yx in group]),
+                           min([big_yx.x for big_yx in group]))
+            big_end = YX(max([big_yx.y for big_yx in group]) + 1,
+                         max([big_yx.x for big_yx in group]) + 1)
+            regions += [(YX(big_start.y * self.map_size.y,
+                            big_start.x * self.map_size.x),
+                         YX((big_end.y - big_start.y) * self.map_size.y,
+                            (big_end.x - big_start.x) * self.map_size.x))]
+        return regions
+
+    def get_flow_field(self, goal, thing):
+        """Return offset, map and Dijkstra map of way to things of goal.
+
+        The Dijkstra map covers the first of .get_flow_regions() that
+        holds thing's view, and leads to all things in it matching
+        self.flow_field_goals[goal]. If no region holds the view, or
+        the one that does has more than .flow_field_max_cells cells,
+        the map only covers the view itself instead.
+
+        Regions are determined once per half-turn, and Dijkstra maps
+        are then shared by all things pursuing the same goal whose
+        views they hold, unless one of the maps (chunks) they were
+        assembled from has since been replaced, or drop_flow_fields()
+        dropped them.
+
+        """
+        view_start = thing.view_offset
+        view_size = YX(thing._radius * 2 + 1, thing._radius * 2 + 1)
+
+        def holds_view(offset, size):
+            return offset.y <= view_start.y and offset.x <= view_start.x \
+                and view_start.y + view_size.y <= offset.y + size.y \
+                and view_start.x + view_size.x <= offset.x + size.x
+
+        if goal not in self.flow_fields:
+            self.flow_fields[goal] = (self.get_flow_regions(), [])
+        regions, fields = self.flow_fields[goal]
+        for field in fields:
+            offset, region, dijkstra_map, maps = field
+            if holds_view(offset, region.size):
+                if all([self.get_map(map_pos, False) is map_
+                        for map_pos, map_ in maps]):
+                    return offset, region, dijkstra_map
+                fields.remove(field)
+                break
+        offset, size = view_start, view_size
+        for region_offset, region_size in regions:
+            if holds_view(region_offset, region_size):
+                if region_size.y * region_size.x <= self.flow_field_max_cells:
+                    offset, size = region_offset, region_size
+                break
+        region = self.map_geometry.get_region(self.map_size, self.get_map,
+                                              offset, size)
+        maps = []
+        for big_y in range(offset.y // self.map_size.y,
+                           (offset.y + size.y - 1) // self.map_size.y + 1):
+            for big_x in range(offset.x // self.map_size.x,
+                               (offset.x + size.x - 1) // self.map_size.x + 1):
+                map_pos = YX(big_y, big_x)
+                maps += [(map_pos, self.get_map(map_pos, False))]
+        targets = [self.map_geometry.pos_in_view(t.position, offset,
+                                                 self.map_size)
+                   for t in self.get_things_in_region(offset, size)
+                   if self.flow_field_goals[goal](t)]
+        dijkstra_map = self.map_geometry.get_dijkstra_map(region, targets)
+        fields += [(offset, region, dijkstra_map, maps)]
+        return offset, region, dijkstra_map
+
+    def drop_flow_fields(self, pos):
+        """Drop cached Dijkstra maps covering pos, e.g. as a target left it."""
+        pos = self.map_geometry.undouble_coordinate(self.map_size, pos)
+        for _, fields in self.flow_fields.values():
+            fields[:] = [(offset, region, dijkstra_map, maps)
+                         for offset, region, dijkstra_map, maps in fields
+                         if not (offset.y <= pos.y < offset.y + region.size.y
+                                 and offset.x <= pos.x
+                                 < offset.x + region.size.x)]
+
+    def get_flow_direction(self, goal, thing):
+        """Return direction for thing to move towards nearest of goal."""
+        offset, region, dijkstra_map = self.get_flow_field(goal, thing)
+        region_pos = self.map_geometry.pos_in_view(thing.position, offset,
+                                                   self.map_size)
+        return self.map_geometry.get_dijkstra_direction(region, dijkstra_map,
+                                                        region_pos)
+
+    def get_things_in_region(self, offset, size):
+        """Return things in rectangle of size from absolute offset.
+
+        Per chunk overlapping the rectangle, either checks all things
+        in the chunk index, or, if there are more of these than cells
+        in the overlap, looks up the overlap's cells in the position
+        index, so that the cost is O(min(things, cells)) per chunk.
+        Things are therefore not returned in any particular order.
+
+        """
+        region_end = offset + size
+        things = []
+        for big_y in range(offset.y // self.map_size.y,
+                           (region_end.y - 1) // self.map_size.y + 1):
+            for big_x in range(offset.x // self.map_size.x,
+                               (region_end.x - 1) // self.map_size.x + 1):
+                big_yx = YX(big_y, big_x)
+                if big_yx not in self.things_by_map:
+                    continue
+                chunk_things = self.things_by_map[big_yx]
+                map_start = YX(big_y * self.map_size.y,
+                               big_x * self.map_size.x)
+                top = max(offset.y, map_start.y) - map_start.y
+                bottom = min(region_end.y,
+                             map_start.y + self.map_size.y) - map_start.y
+                left = max(offset.x, map_start.x) - map_start.x
+                right = min(region_end.x,
+                            map_start.x + self.map_size.x) - map_start.x
+                if len(chunk_things) <= (bottom - top) * (right - left):
+                    for t in chunk_things.values():
+                        pos = t.position[1]
+                        if top <= pos.y < bottom and left <= pos.x < right:
+                            things += [t]
+                    continue
+                for y in range(top, bottom):
+                    for x in range(left, right):
+                        pos = (big_yx, YX(y, x))
+                        if pos in self.things_by_pos:
+                            things += self.things_by_pos[pos].values()
+        return things
+
+    def get_spawn_cells(self, map_pos):
+        """Return (cached) list of position indices of '.' cells of map.
+
+        Callers changing a map's terrain must drop its entry from
+        self.spawn_cells.
+
+        """
+        if map_pos not in self.spawn_cells:
+            terrain = self.maps[map_pos].terrain
+            self.spawn_cells[map_pos] = [i for i, c in enumerate(terrain)
+                                         if c == ord('.')]
+        return self.spawn_cells[map_pos]
+
+    def spawn_food(self):
+        """Spawn food on free '.' cells of all maps by .food_spawn_chance.
+
+        Rather than rolling the dice for each cell, draws from the
+        game's PRNG the geometrically distributed number of cells to
+        skip until the next spawn, so that the cost of this grows with
+        the number of spawns, not with the number of cells. A chance
+        of 0 or less spawns nothing, one of 1 or more spawns on every
+        free cell. Maps already holding .food_max_per_map food get no
+        more.
+
+        """
+        if self.food_spawn_chance <= 0:
+            return
+        map_positions = []
+        cells_counts = []
+        n_cells = 0
+        for map_pos in self.maps:
+            if self.maps[map_pos].size == self.map_size:
+                n_cells += len(self.get_spawn_cells(map_pos))
+                map_positions += [map_pos]
+                cells_counts += [n_cells]
+        n_food = {}
+
+        def spawn(map_pos, pos_i):
+            if map_pos not in n_food:
+                n_food[map_pos] = len([t for t in self.things_by_map.get(
+                                           map_pos, {}).values()
+                                       if t.type_ == 'food'])
+            if n_food[map_pos] >= self.food_max_per_map:
+                return
+            pos = (map_pos, YX(pos_i // self.map_size.x,
+                               pos_i % self.map_size.x))
+            if len(self.things_at_pos(pos)) == 0:
+                self.add_thing_at('food', pos)
+                n_food[map_pos] += 1
+
+        if self.food_spawn_chance >= 1:
+            for map_pos in map_positions:
+                for pos_i in self.get_spawn_cells(map_pos):
+                    spawn(map_pos, pos_i)
+            return
+        log_no_spawn = math.log(1 - self.food_spawn_chance)
+        i = -1
+        while True:
+            dice = self.rand.random()
+            if dice == 0:
+                break
+            i += 1 + int(math.log(dice) / log_no_spawn)
+            if i >= n_cells:
+                break
+            map_i = bisect.bisect_right(cells_counts, i)
+            cells_before = cells_counts[map_i - 1] if map_i > 0 else 0
+            spawn(map_positions[map_i],
+                  self.get_spawn_cells(map_positions[map_i])[i - cells_before])
+
     def proceed_to_next_player_turn(self):
         """Run game world turns until player can decide their next step.
 
@@ -228,18 +761,17 @@ class Game(GameBase):
         breaks.
 
         """
+        self.flow_fields = {}
         while True:
-            player_i = self.things.index(self.player)
-            for thing in self.things[player_i+1:]:
-                thing.proceed()
+            things, player_i = self.get_turn_order()
+            for i in range(player_i + 1, len(things)):
+                things[i].proceed()
             self.turn += 1
-            for pos in self.maps[YX(0,0)]:
-                if self.maps[YX(0,0)][pos] == '.' and \
-                   len(self.things_at_pos((YX(0,0), pos))) == 0 and \
-                   self.rand.random() > 0.999:
-                    self.add_thing_at('food', (YX(0,0), pos))
-            for thing in self.things[:player_i]:
-                thing.proceed()
+            self.flow_fields = {}
+            self.spawn_food()
+            things, player_i = self.get_turn_order()
+            for i in range(player_i):
+                things[i].proceed()
             self.player.proceed(is_AI=False)
             if self.player.task is None or not self.player_is_alive:
                 break
@@ -247,7 +779,7 @@ class Game(GameBase):
     def add_thing_at(self, type_, pos):
         t = self.thing_types[type_](self)
         t.position = pos
-        self.things += [t]
+        self.add_thing(t)
         return t
 
     def make_new_world(self, yx, seed):
@@ -267,10 +799,12 @@ class Game(GameBase):
         self.rand.seed(seed)
         self.turn = 0
         self.maps = {}
+        self.flow_fields = {}
         self.map_size = yx
         map_ = self.get_map(YX(0,0))
-        for pos in map_:
-            map_[pos] = self.rand.choice(('.', '.', '.', '~', 'x'))
+        map_.fill(bytes([ord(self.rand.choice(('.', '.', '.', '~', 'x')))
+                         for i in range(map_.size_i)]))
+        self.spawn_cells = {}
         player = add_thing_at_random('human')
         self.player_id = player.id_
         add_thing_at_random('monster')
@@ -281,3 +815,92 @@ class Game(GameBase):
         add_thing_at_random('food')
         return 'success'
 
+
+
+class TestGame(unittest.TestCase):
+
+    def test_thing_index(self):
+        with tempfile.TemporaryDirectory() as dir_name:
+            game = Game(os.path.join(dir_name, 'game'))
+            game.io.handle_input('GEN_WORLD Y:8,X:8 3')
+            a = game.add_thing_at('food', (YX(0, 0), YX(1, 1)))
+            b = game.add_thing_at('monster', (YX(0, 0), YX(1, 2)))
+            chunk = list(game.things_by_map[YX(0, 0)].values())
+            a.position = (YX(0, 0), YX(1, 3))
+            self.assertEqual(list(game.things_by_map[YX(0, 0)].values()),
+                             chunk)
+            self.assertEqual(game.things_at_pos((YX(0, 0), YX(1, 3))), [a])
+            self.assertNotIn((YX(0, 0), YX(1, 1)), game.things_by_pos)
+            b.position = (YX(0, 1), YX(1, 0))
+            self.assertIs(game.blocking_thing_at((YX(0, 1), YX(1, 0))), b)
+            self.assertNotIn(b.id_, game.things_by_map[YX(0, 0)])
+            c = game.add_thing_at('food', (YX(0, 0), YX(1, 7)))
+            self.assertEqual(set(game.get_things_in_region(YX(1, 7),
+                                                           YX(1, 2))),
+                             set(game.things_at_pos(c.position) + [b]))
+            game.remove_thing(b)
+            self.assertNotIn(YX(0, 1), game.things_by_map)
+
+    def test_spawn_food(self):
+        with tempfile.TemporaryDirectory() as dir_name:
+            game = Game(os.path.join(dir_name, 'game'))
+            game.io.handle_input('GEN_WORLD Y:8,X:8 3')
+            n_things = len(game.things)
+            game.food_spawn_chance = 0
+            game.spawn_food()
+            self.assertEqual(len(game.things), n_things)
+            game.food_spawn_chance = 1
+            game.food_max_per_map = 10
+            game.spawn_food()
+            self.assertEqual(len([t for t in game.things_by_map[YX(0, 0)]
+                                  .values() if t.type_ == 'food']), 10)
+            game.food_max_per_map = 1000
+            game.spawn_food()
+            for pos_i in game.get_spawn_cells(YX(0, 0)):
+                pos = (YX(0, 0), YX(pos_i // 8, pos_i % 8))
+                self.assertNotEqual(game.things_at_pos(pos), [])
+
+    def test_turn_order(self):
+        with tempfile.TemporaryDirectory() as dir_name:
+            game = Game(os.path.join(dir_name, 'game'))
+            game.io.handle_input('GEN_WORLD Y:8,X:8 3')
+            things, player_i = game.get_turn_order()
+            self.assertIs(things[player_i], game.player)
+            food = game.add_thing_at('food', (YX(0, 0), YX(1, 1)))
+            self.assertIs(game.get_turn_order()[0], things)
+            self.assertIs(things[-1], food)
+            game.remove_thing(things[player_i - 1 if player_i else -1])
+            self.assertEqual(game.get_turn_order()[0], game.things)
+            self.assertIs(game.things[game.get_turn_order()[1]], game.player)
+
+    def test_flow_field(self):
+        with tempfile.TemporaryDirectory() as dir_name:
+            game = Game(os.path.join(dir_name, 'game'))
+            game.io.handle_input('GEN_WORLD Y:32,X:32 3')
+            game.player.position = (YX(20, 20), YX(5, 5))
+            monster = [t for t in game.things if t.type_ == 'monster'][0]
+            far = game.add_thing_at('monster', (YX(5, 5), YX(16, 16)))
+            self.assertEqual(len(game.get_flow_regions()), 2)
+            offset, region, _ = game.get_flow_field('food', monster)
+            self.assertEqual(offset.y % 32 + offset.x % 32, 0)
+            self.assertLessEqual(region.size.y, 3 * 32)
+            self.assertLessEqual(region.size.x, 3 * 32)
+            fields = game.flow_fields['food'][1]
+            self.assertIs(game.get_flow_field('food', monster)[2],
+                          fields[0][2])
+            self.assertEqual(game.get_flow_field('food', far)[0],
+                             YX(5 * 32, 5 * 32))
+            self.assertEqual(len(fields), 2)
+            for big_yx, map_ in fields[0][3]:
+                if map_ is not None:
+                    game.maps[big_yx] = Map(game.map_size, '.')
+                    break
+            dijkstra_map = fields[0][2]
+            self.assertIsNot(game.get_flow_field('food', monster)[2],
+                             dijkstra_map)
+            game.drop_flow_fields(monster.position)
+            self.assertEqual(len(fields), 1)
+            game.flow_field_max_cells = 17 * 17
+            game.flow_fields = {}
+            self.assertEqual(game.get_flow_field('food', monster)[0],
+                             monster.view_offset)
@@ -1,14 +1,18 @@
+import asyncio
+import collections
+import glob
+import os
 import queue
+import re
+import tempfile
 import threading
-import socketserver
+import unittest
+import uuid
 from plomrogue.errors import GameError, ArgError, BrokenSocketConnection
+from plomrogue.journal import Journal
 from plomrogue.parser import Parser
 from plomrogue.misc import quote
-
-
-
-# Avoid "Address already in use" errors.
-socketserver.TCPServer.allow_reuse_address = True
+from plomrogue import snapshot
 
 
 
@@ -17,14 +21,29 @@ class PlomSocket:
     def __init__(self, socket):
         self.socket = socket
 
+    @staticmethod
+    def encode(message):
+        """Encode message to bytes, escaped/delimited as recv() expects.
+
+        In detail, all \\ and $ in message are escaped with prefixed \\,
+        and an unescaped $ is appended as a message delimiter.
+
+        """
+        return (message.replace('\\', '\\\\').replace('$', '\\$') +
+                '$').encode()
+
     def send(self, message, silent_connection_break=False):
-        """Send via self.socket, encoded/delimited as way recv() expects.
+        """Send message via self.socket, encoded as per encode()."""
+        self.send_bytes(self.encode(message), silent_connection_break)
+
+    def send_bytes(self, data, silent_connection_break=False):
+        """Send already encode()d data fully via self.socket.
 
-        In detail, all \ and $ in message are escaped with prefixed \,
-        and an unescaped $ is appended as a message delimiter. Then,
-        socket.send() is called as often as necessary to ensure
-        message is sent fully, as socket.send() due to buffering may
-        not send all of it right away.
+        Data may hold any number of encoded messages at once, so they
+        can be written in as few socket.send() calls as possible. That
+        is called as often as necessary to ensure data is sent fully,
+        as socket.send() due to buffering may not send all of it right
+        away.
 
         Assuming socket is blocking, it's rather improbable that
         socket.send() will be partial / return a positive value less
@@ -38,25 +57,21 @@ class PlomSocket:
         <http://stackoverflow.com/q/34919846>
 
         """
-        escaped_message = ''
-        for char in message:
-            if char in ('\\', '$'):
-                escaped_message += '\\'
-            escaped_message += char
-        escaped_message += '$'
-        data = escaped_message.encode()
+        view = memoryview(data)
         totalsent = 0
         while totalsent < len(data):
-            socket_broken = False
+            sent = 0
             try:
-                sent = self.socket.send(data[totalsent:])
+                sent = self.socket.send(view[totalsent:])
                 socket_broken = sent == 0
             except OSError as err:
                 if err.errno == 9:  # "Bad file descriptor", when connection broken
                     socket_broken = True
                 else:
                     raise err
-            if socket_broken and not silent_connection_break:
+            if socket_broken:
+                if silent_connection_break:
+                    return
                 raise BrokenSocketConnection
             totalsent = totalsent + sent
 
@@ -77,109 +92,328 @@ class PlomSocket:
         the input is segmented in any other meaningful way; that's why
         we do our own message segmentation with $ as a delimiter.
 
+        We receive into one reusable buffer via socket.recv_into()
+        and leave the segmentation to a MessageDecoder.
+
         """
-        esc = False
-        data = b''
-        msg = b''
+        decoder = MessageDecoder()
+        buf = bytearray(65536)
+        view = memoryview(buf)
         while True:
-            data += self.socket.recv(1024)
-            if 0 == len(data):
+            n_bytes = self.socket.recv_into(buf)
+            if 0 == n_bytes:
                 return
-            cut_off = 0
-            for c in data:
-                cut_off += 1
-                if esc:
-                    msg += bytes([c])
-                    esc = False
-                elif chr(c) == '\\':
-                    esc = True
-                elif chr(c) == '$':
-                    try:
-                        yield msg.decode()
-                    except UnicodeDecodeError:
-                        yield None
-                    data = data[cut_off:]
-                    msg = b''
-                else:
-                    msg += bytes([c])
+            yield from decoder.feed(view[:n_bytes])
 
 
 
-class Server(socketserver.ThreadingTCPServer):
-    """Bind together threaded IO handling server and message queue."""
+class MessageDecoder:
+    """Split byte stream into messages delimited by unescaped $.
 
-    def __init__(self, queue, port, *args, **kwargs):
-        super().__init__(('localhost', port), IO_Handler, *args, **kwargs)
+    Bytes of messages not yet completed are kept between calls of
+    .feed(), including an escaping backslash at the end of the data fed.
+
+    """
+    special_bytes = re.compile(rb'[\\$]')
+
+    def __init__(self):
+        self.msg = bytearray()
+        self.escaped = False
+
+    def feed(self, data):
+        """Yield messages completed by data, None for non-Unicode ones.
+
+        Rather than walking data byte by byte, searches for the next
+        escape or delimiter, and copies everything in between at once.
+
+        """
+        pos = 0
+        if self.escaped and len(data) > 0:
+            self.msg += data[:1]
+            self.escaped = False
+            pos = 1
+        while True:
+            match = self.special_bytes.search(data, pos)
+            if match is None:
+                self.msg += data[pos:]
+                return
+            i = match.start()
+            self.msg += data[pos:i]
+            if data[i] == ord('$'):
+                try:
+                    yield self.msg.decode()
+                except UnicodeDecodeError:
+                    yield None
+                self.msg = bytearray()
+                pos = i + 1
+            elif i + 1 == len(data):
+                self.escaped = True
+                return
+            else:
+                self.msg += data[i + 1:i + 2]
+                pos = i + 2
+
+
+
+class Server:
+    """Serve all client connections from one asyncio event loop.
+
+    Messages to the game IO loop are put into self.queue_out as
+    tuples, with the first element a meta command ('ADD_QUEUE' for
+    queue creation, 'KILL_QUEUE' for queue deletion, and 'COMMAND' for
+    everything else), the second element a UUID that uniquely
+    identifies the connection (so that the game IO loop knows whom to
+    send replies back to), and optionally a third element for further
+    instructions.
+
+    Data not yet written to a connection is limited to max_messages
+    messages and max_bytes bytes. If a client falls further behind,
+    overflow_policy decides: 'resync' drops the game state data queued
+    for it, keeping the replies, and requests a fresh full game state
+    in its place (see GameIO.resync()); 'disconnect' drops the
+    connection. A resyncing connection that overflows again before
+    any data was written to it is dropped too, as then not even one
+    full game state may fit the limits, and so is one whose replies
+    alone overflow.
+
+    """
+
+    def __init__(self, queue, port, max_messages=10000, max_bytes=2**23,
+                 overflow_policy='resync'):
+        if overflow_policy not in {'resync', 'disconnect'}:
+            raise ArgError('Unknown overflow policy: %s' % overflow_policy)
         self.queue_out = queue
-        self.daemon_threads = True  # Else, server's threads have daemon=False.
+        self.port = port
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.overflow_policy = overflow_policy
+        self.queues_in = {}
 
+    def serve_forever(self):
+        """Run event loop serving connections until interrupted."""
+        asyncio.run(self.serve())
 
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, 'localhost',
+                                            self.port, reuse_address=True)
+        async with server:
+            await server.serve_forever()
 
-class IO_Handler(socketserver.BaseRequestHandler):
+    def get_queue_stats(self):
+        """Return 'QUEUE_STATS' message on all connections' OutboundQueues.
 
-    def handle(self):
+        Its fields are the number of connections, the messages and
+        bytes queued in total, the highest number of bytes any queue
+        ever held, and the number of overflows so far.
+
+        """
+        queues = self.queues_in.values()
+        return 'QUEUE_STATS %s %s %s %s %s' % (
+            len(queues), sum([q.n_messages for q in queues]),
+            sum([q.n_bytes for q in queues]),
+            max([q.peak_bytes for q in queues], default=0),
+            sum([q.overflows for q in queues]))
+
+    async def handle(self, reader, writer):
         """Move messages between network socket and game IO loop via queues.
 
         On start (a new connection from client to server), sets up a
-        new queue, sends it via self.server.queue_out to the game IO
-        loop thread, and from then on receives messages to send back
-        from the game IO loop via that new queue.
-
-        At the same time, loops over socket's recv to get messages
-        from the outside into the game IO loop by way of
-        self.server.queue_out into the game IO. Ends connection once a
-        'QUIT' message is received from socket, and then also calls
-        for a kill of its own queue.
-
-        All messages to the game IO loop are tuples, with the first
-        element a meta command ('ADD_QUEUE' for queue creation,
-        'KILL_QUEUE' for queue deletion, and 'COMMAND' for everything
-        else), the second element a UUID that uniquely identifies the
-        thread (so that the game IO loop knows whom to send replies
-        back to), and optionally a third element for further
-        instructions.
+        new OutboundQueue, sends it via self.queue_out to the game IO
+        loop thread, and from then on writes data it receives from the
+        game IO loop via that new queue to the socket.
+
+        At the same time, reads from the socket to get messages from
+        the outside into the game IO loop by way of self.queue_out.
+        Ends connection once a 'QUIT' message is received from socket,
+        or the socket is closed, and then also calls for a kill of its
+        own queue. A 'QUEUE_STATS' message is answered directly, see
+        get_queue_stats().
 
         """
 
-        def send_queue_messages(plom_socket, queue_in, thread_alive):
-            """Send messages via socket from queue_in while thread_alive[0]."""
-            while thread_alive[0]:
-                try:
-                    msg = queue_in.get(timeout=1)
-                except queue.Empty:
-                    continue
-                plom_socket.send(msg, True)
+        async def send_queue_data(queue_in):
+            """Write data from queue_in to writer, joined if piled up."""
+            nonlocal resyncing
+            try:
+                while True:
+                    writer.write(await queue_in.get())
+                    # Replies kept while a resync is due don't end it.
+                    if not queue_in.awaiting_resync:
+                        resyncing = False
+                    await writer.drain()
+            except ConnectionError:
+                writer.close()
 
-        import uuid
-        plom_socket = PlomSocket(self.request)
-        print('CONNECTION FROM:', str(self.client_address))
+        def on_overflow(queue_in):
+            nonlocal resyncing
+            if self.overflow_policy == 'resync' and not resyncing:
+                queue_in.drop_game_states()
+                if not queue_in.is_overfull():
+                    resyncing = True
+                    self.queue_out.put(('RESYNC', connection_id))
+                    return
+            queue_in.clear()
+            if not writer.is_closing():
+                print('DISCONNECTING SLOW CLIENT:', str(peer))
+                writer.transport.abort()
+
+        resyncing = False
+        peer = writer.get_extra_info('peername')
+        print('CONNECTION FROM:', str(peer))
         connection_id = uuid.uuid4()
-        queue_in = queue.Queue()
-        self.server.queue_out.put(('ADD_QUEUE', connection_id, queue_in))
-        thread_alive = [True]
-        t = threading.Thread(target=send_queue_messages,
-                             args=(plom_socket, queue_in, thread_alive))
-        t.start()
-        for message in plom_socket.recv():
-            if message is None:
-                plom_socket.send('BAD MESSAGE', True)
-            elif 'QUIT' == message:
-                plom_socket.send('BYE', True)
-                break
-            else:
-                self.server.queue_out.put(('COMMAND', connection_id, message))
-        self.server.queue_out.put(('KILL_QUEUE', connection_id))
-        thread_alive[0] = False
-        print('CONNECTION CLOSED FROM:', str(self.client_address))
-        plom_socket.socket.close()
+        queue_in = OutboundQueue(self.max_messages, self.max_bytes,
+                                 on_overflow)
+        self.queues_in[connection_id] = queue_in
+        self.queue_out.put(('ADD_QUEUE', connection_id, queue_in))
+        sender = asyncio.create_task(send_queue_data(queue_in))
+        decoder = MessageDecoder()
+        try:
+            while not writer.is_closing():
+                data = await reader.read(65536)
+                if 0 == len(data):
+                    break
+                for message in decoder.feed(data):
+                    if message is None:
+                        writer.write(PlomSocket.encode('BAD MESSAGE'))
+                    elif 'QUIT' == message:
+                        writer.write(PlomSocket.encode('BYE'))
+                        await writer.drain()
+                        writer.close()
+                        break
+                    elif 'QUEUE_STATS' == message:
+                        writer.write(PlomSocket.encode(self.get_queue_stats()))
+                    else:
+                        self.queue_out.put(('COMMAND', connection_id,
+                                            message))
+        except ConnectionError:
+            pass
+        finally:
+            self.queue_out.put(('KILL_QUEUE', connection_id))
+            del self.queues_in[connection_id]
+            sender.cancel()
+            writer.close()
+            print('CONNECTION CLOSED FROM:', str(peer))
+
+
+
+# What the game IO loop thread passes to a connection per flush: data
+# holding n_messages messages, of which the ones not game state data
+# (see GameIO.send_to()) are also joined into kept (n_kept of them),
+# and whether it answers a resync (see GameIO.resync()).
+OutboundItem = collections.namedtuple('OutboundItem',
+                                      ('data', 'n_messages', 'kept',
+                                       'n_kept', 'resync'))
+
+
+
+class OutboundQueue:
+    """Hold data from the game IO loop thread for a connection's writer.
+
+    The game IO loop thread put()s OutboundItems. Once more than
+    max_messages messages or max_bytes bytes are held, on_overflow is
+    called with the queue as argument. After drop_game_states(), only
+    the kept part of items is held, until an item answering a resync
+    comes in.
+
+    """
+
+    def __init__(self, max_messages, max_bytes, on_overflow):
+        self.loop = asyncio.get_running_loop()
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.on_overflow = on_overflow
+        self.items = []
+        self.n_messages = 0
+        self.n_bytes = 0
+        self.peak_bytes = 0
+        self.overflows = 0
+        self.awaiting_resync = False
+        self.filled = asyncio.Event()
+
+    def put(self, item):
+        """Pass item to the event loop; safe to call from other threads."""
+        self.loop.call_soon_threadsafe(self.put_nowait, item)
+
+    def put_nowait(self, item):
+        if item.resync:
+            self.awaiting_resync = False
+        elif self.awaiting_resync:
+            item = OutboundItem(item.kept, item.n_kept, item.kept,
+                                item.n_kept, False)
+        self.items += [item]
+        self.n_messages += item.n_messages
+        self.n_bytes += len(item.data)
+        self.peak_bytes = max(self.peak_bytes, self.n_bytes)
+        self.filled.set()
+        if self.is_overfull():
+            self.overflows += 1
+            self.on_overflow(self)
+
+    def is_overfull(self):
+        return self.n_messages > self.max_messages or \
+            self.n_bytes > self.max_bytes
+
+    def drop_game_states(self):
+        """Drop all but the kept part of items, until a resync comes in.
+
+        That is, drop game state data, which the game state sent in
+        answer to a resync will replace, but keep replies that clients
+        could get no other way.
+
+        """
+        items = [OutboundItem(item.kept, item.n_kept, item.kept,
+                              item.n_kept, False) for item in self.items]
+        self.clear()
+        self.awaiting_resync = True
+        for item in items:
+            if item.n_messages > 0:
+                self.items += [item]
+                self.n_messages += item.n_messages
+                self.n_bytes += len(item.data)
+        if len(self.items) > 0:
+            self.filled.set()
+
+    def clear(self):
+        self.items = []
+        self.n_messages = 0
+        self.n_bytes = 0
+        self.filled.clear()
+
+    async def get(self):
+        """Wait for data, then return all of it joined, and clear."""
+        # A waiter may be woken for data cleared away right after.
+        while len(self.items) == 0:
+            await self.filled.wait()
+        data = b''.join([item.data for item in self.items])
+        self.clear()
+        return data
 
 
 
 class GameIO():
+    """Move game commands and replies between game, game file and clients.
+
+    Any journal_options are passed on to the game file's Journal,
+    such as its durability policy and sync_interval.
 
-    def __init__(self, game_file_name, game):
+    """
+
+    def __init__(self, game_file_name, game, **journal_options):
         self.game_file_name = game_file_name
         self.queues_out = {}
+        self.pending_out = []
+        self.gamestate_modes = {}
+        self.sent_gamestates = {}
+        self.resyncs = set()
+        self.journal = Journal(game_file_name, **journal_options)
+        self.snapshot_interval = 1000
+        self.snapshot_number = 0
+        self.snapshots_kept = 10
+        self.compacting = False
+        self.loop_queue = None
+        self.writers = {}
+        self.indexed_turn = None
+        self.game = game
         self.parser = Parser(game)
 
     def loop(self, q):
@@ -199,43 +433,224 @@ class GameIO():
         that is the tuple's third element. The game_command_handler takes
         care of processing this and sending out replies.
 
+        Whatever commands have piled up in q are handled as one batch.
+        Only after the batch, the game file journal is committed, and
+        then the replies collected are flushed as one chunk of data per
+        receiver – so no client learns of a change before it has been
+        written. If the journal awaits an fsync, q is only waited on
+        until that is due. Once self.snapshot_interval lines have been
+        committed since the last compaction, the journal is compacted
+        into a snapshot of the game (see compact()). A 'CALL' command
+        calls its third element, which is how write_in_background()
+        reports back. A 'RESYNC' command calls resync() for its
+        receiver. A 'STOP' command ends the loop after its batch:
+        once that is handled like any other, background writes and
+        their reports are waited for, and the journal is closed. A
+        game under way whose journal has no history yet is compacted
+        right away, so its history starts from a snapshot.
+
         """
+        self.loop_queue = q
+        # Without history so far, checkpoint the state it starts from.
+        if self.journal.history and self.journal.get_history_offset() == 0 \
+           and self.game.map_size is not None:
+            self.compact()
+        self.journal.commit()
         while True:
-            x = q.get()
-            command_type = x[0]
-            connection_id = x[1]
-            content = None if len(x) == 2 else x[2]
-            if command_type == 'ADD_QUEUE':
-                self.queues_out[connection_id] = content
-            elif command_type == 'KILL_QUEUE':
-                del self.queues_out[connection_id]
-            elif command_type == 'COMMAND':
-                self.handle_input(content, connection_id)
-
-    def run_loop_with_server(self):
+            try:
+                batch = [q.get(timeout=self.journal.get_sync_timeout())]
+            except queue.Empty:
+                batch = []
+            while True:
+                try:
+                    batch += [q.get_nowait()]
+                except queue.Empty:
+                    break
+            stop = False
+            for i, x in enumerate(batch):
+                command_type = x[0]
+                connection_id = x[1]
+                content = None if len(x) == 2 else x[2]
+                if command_type == 'ADD_QUEUE':
+                    self.queues_out[connection_id] = content
+                elif command_type == 'KILL_QUEUE':
+                    del self.queues_out[connection_id]
+                    if connection_id in self.gamestate_modes:
+                        del self.gamestate_modes[connection_id]
+                    if connection_id in self.sent_gamestates:
+                        del self.sent_gamestates[connection_id]
+                elif command_type == 'COMMAND':
+                    self.handle_input(content, connection_id)
+                elif command_type == 'RESYNC':
+                    self.resync(connection_id)
+                elif command_type == 'CALL':
+                    content()
+                elif command_type == 'STOP':
+                    stop = True
+                    left = batch[i + 1:]
+                    break
+            self.journal.commit()
+            if not self.compacting and \
+               self.journal.n_lines - self.journal.n_lines_compacted >= \
+               self.snapshot_interval:
+                self.compact()
+            self.flush()
+            if stop:
+                for writer in self.writers.values():
+                    writer.join()
+                while not q.empty():
+                    left += [q.get_nowait()]
+                for x in left:
+                    if x[0] == 'CALL':
+                        x[2]()
+                self.loop_queue = None
+                self.journal.close()
+                self.flush()
+                return
+
+    def get_snapshot_file_name(self, number):
+        return '%s.snapshot.%s' % (self.game_file_name, number)
+
+    def compact(self):
+        """Compact game file to current game state snapshot plus tail.
+
+        The game state is written as the next binary snapshot file
+        (see snapshot.dump()) next to the game file, which is then
+        compacted to start with a LOAD_SNAPSHOT command for it. So on
+        startup, the game file replays fast no matter how long the
+        game has run. The last self.snapshots_kept snapshots are kept
+        as checkpoints of the journal's history, and indexed there;
+        history from before them is dropped with the older snapshots
+        (see Journal.trim_history()). If the journal keeps no history,
+        all other snapshot files are removed.
+
+        Only a copy of the game state is taken in the game loop (see
+        Game.get_save_state()); it is serialized and written out in
+        the background (see write_in_background()), and the game file
+        is compacted once that is done.
+
+        """
+        self.journal.commit()
+        offset = self.journal.get_offset()
+        history_offset = self.journal.get_history_offset()
+        pattern = glob.escape(self.game_file_name) + '.snapshot.*'
+        prefix_length = len(self.get_snapshot_file_name(''))
+        for old_file_name in glob.glob(pattern):
+            if old_file_name[prefix_length:].isdigit():
+                self.snapshot_number = max(self.snapshot_number,
+                                           int(old_file_name[prefix_length:]))
+        self.snapshot_number += 1
+        file_name = self.get_snapshot_file_name(self.snapshot_number)
+        state = self.game.get_save_state()
+
+        def done(error):
+            self.compacting = False
+            if error is not None:
+                print('Snapshot failed: ' + error)
+                return
+            self.journal.compact(['LOAD_SNAPSHOT %s' %
+                                  quote(os.path.basename(file_name))], offset)
+            self.journal.index_snapshot(file_name, history_offset)
+            if self.journal.history:
+                old_file_names = \
+                    self.journal.trim_history(self.snapshots_kept)
+            else:
+                old_file_names = glob.glob(pattern)
+            for old_file_name in old_file_names:
+                if old_file_name != file_name and \
+                   os.path.exists(old_file_name):
+                    os.remove(old_file_name)
+
+        self.compacting = True
+        self.write_in_background(file_name, lambda: snapshot.dump(state),
+                                 done)
+
+    def write_in_background(self, file_name, get_data, done):
+        """Write get_data() to file_name atomically, outside the game loop.
+
+        get_data is called in a thread of its own, so it must only
+        read state captured beforehand. What it returns (bytes or
+        str) is written to a temporary file, which is fsync'd and
+        then moved to file_name. Then done is called back in the
+        loop() thread with None, or with an error message if writing,
+        or get_data() by an ArgError or GameError, failed. Outside of
+        loop(), all this happens right away.
+
+        Raises GameError if file_name is still being written.
+
+        """
+
+        def write():
+            try:
+                data = get_data()
+                tmp_file_name = file_name + '.tmp'
+                mode = 'wb' if isinstance(data, bytes) else 'w'
+                with open(tmp_file_name, mode) as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_file_name, file_name)
+            except (OSError, ArgError, GameError) as e:
+                return str(e)
+            return None
+
+        if self.loop_queue is None:
+            done(write())
+            return
+        if file_name in self.writers and self.writers[file_name].is_alive():
+            raise GameError('Already writing %s.' % file_name)
+        q = self.loop_queue
+
+        def write_and_report():
+            error = write()
+            q.put(('CALL', None, lambda: done(error)))
+
+        self.writers = {name: writer for name, writer in self.writers.items()
+                        if writer.is_alive()}
+        self.writers[file_name] = threading.Thread(target=write_and_report)
+        self.writers[file_name].start()
+
+    def is_writing(self, prefix):
+        """Return whether a file name starting with prefix is being written."""
+        return True in [name.startswith(prefix) and writer.is_alive()
+                        for name, writer in self.writers.items()]
+
+    def run_loop_with_server(self, durability=None, sync_interval=None,
+                             **server_options):
         """Run connection of server talking to clients and game IO loop.
 
         We have the TCP server (an instance of Server) and we have the
         game IO loop, a thread running self.loop. Both communicate with
-        each other via a queue.Queue. While the TCP server may spawn
-        parallel threads to many clients, the IO loop works sequentially
-        through game commands received from the TCP server's threads (=
-        client connections to the TCP server). A processed command may
-        trigger messages to the commanding client or to all clients,
-        delivered from the IO loop to the TCP server via the queue.
+        each other via a queue.Queue. While the TCP server's event loop
+        may serve many clients concurrently, the IO loop works
+        sequentially through game commands received from the client
+        connections to the TCP server. A processed command may trigger
+        messages to the commanding client or to all clients, delivered
+        from the IO loop to the connections' own queues.
+
+        Any server_options are passed on to the Server, such as limits
+        on those queues. If durability is given, the game file's
+        Journal switches to it (and to sync_interval, if given) before
+        the IO loop starts.
 
         """
+        if durability is not None:
+            self.journal.set_durability(durability, sync_interval)
+        elif sync_interval is not None:
+            self.journal.sync_interval = sync_interval
         q = queue.Queue()
         c = threading.Thread(target=self.loop, daemon=True, args=(q,))
         c.start()
-        server = Server(q, 5000)
+        server = Server(q, 5000, **server_options)
         try:
             server.serve_forever()
         except KeyboardInterrupt:
             pass
         finally:
             print('Killing server')
-            server.server_close()
+            q.put(('STOP', None))
+            c.join(timeout=5)
+            print(self.journal.get_stats())
 
     def handle_input(self, input_, connection_id=None, store=True):
         """Process input_ to command grammar, call command handler if found."""
@@ -257,23 +672,372 @@ class GameIO():
                 else:
                     command(*args)
                     if store and not hasattr(command, 'dont_save'):
-                        with open(self.game_file_name, 'a') as f:
-                            f.write(input_ + '\n')
+                        self.journal.write(input_)
+                        if self.game.turn != self.indexed_turn:
+                            self.journal.index_turn(self.game.turn)
+                            self.indexed_turn = self.game.turn
         except ArgError as e:
             answer(connection_id, 'ARGUMENT_ERROR ' + quote(str(e)))
         except GameError as e:
             answer(connection_id, 'GAME_ERROR ' + quote(str(e)))
 
-    def send(self, msg, connection_id=None):
-        """Send message msg to server's client(s) via self.queues_out.
+    def get_receivers(self, connection_id=None, gamestate_mode=None):
+        """Return IDs of clients that send() would send to."""
+        if connection_id:
+            receivers = [connection_id]
+        else:
+            receivers = list(self.queues_out)
+        if gamestate_mode:
+            receivers = [i for i in receivers
+                         if self.gamestate_modes.get(i, 'lines')
+                         == gamestate_mode]
+        return receivers
+
+    def send(self, msg, connection_id=None, gamestate_mode=None):
+        """Queue message msg for server's client(s), see flush().
 
         If a specific client is identified by connection_id, only
         sends msg to that one. Else, sends it to all clients
-        identified in self.queues_out.
+        identified in self.queues_out. If gamestate_mode is set,
+        skips clients that chose another one (default: 'lines').
 
         """
-        if connection_id:
-            self.queues_out[connection_id].put(msg)
-        else:
-            for connection_id in self.queues_out:
-                self.queues_out[connection_id].put(msg)
+        self.send_to(msg, self.get_receivers(connection_id, gamestate_mode))
+
+    def send_to(self, msg, receivers, game_state=False):
+        """Queue message msg for all clients identified in receivers.
+
+        The message is encoded only once, and queued only once
+        together with receivers, no matter how many there are. Mark
+        game state data by game_state, so that a resync may drop it.
+
+        """
+        if len(receivers) == 0:
+            return
+        self.pending_out += [(receivers, PlomSocket.encode(msg), game_state)]
+
+    def resync(self, connection_id):
+        """Send full game state to connection_id, whose queue overflowed.
+
+        Its OutboundQueue dropped the game state data it held, and
+        drops more until it gets this resync's (see
+        OutboundQueue.drop_game_states()). So forget what game state it
+        was last sent, which deltas would otherwise build on, and take
+        it off the receivers of game state data still pending, too.
+
+        """
+        if connection_id not in self.queues_out:
+            return
+        for receivers, _, game_state in self.pending_out:
+            if game_state and connection_id in receivers:
+                receivers.remove(connection_id)
+        self.sent_gamestates.pop(connection_id, None)
+        self.resyncs.add(connection_id)
+        self.game.send_gamestate(connection_id)
+
+    def flush(self):
+        """Pass messages queued by send() to self.queues_out.
+
+        All messages pending for one client are joined into a single
+        bytes object, so its Server connection can write them out at
+        once, and put() into its queue as an OutboundItem. One pass
+        over the messages queued collects each client's; the clients
+        that got the very same messages (e.g. only broadcasts) share a
+        single item, and thus the very same bytes objects.
+
+        """
+        chunks_by_receiver = {}
+        for receivers, data, game_state in self.pending_out:
+            for connection_id in receivers:
+                if connection_id in chunks_by_receiver:
+                    chunks_by_receiver[connection_id].append((data,
+                                                              game_state))
+                else:
+                    chunks_by_receiver[connection_id] = [(data, game_state)]
+        items = {}
+        for connection_id, chunks in chunks_by_receiver.items():
+            if connection_id not in self.queues_out:
+                continue
+            resync = connection_id in self.resyncs
+            # The chunks stay alive in self.pending_out until we are done.
+            key = (resync,) + tuple([id(data) for data, _ in chunks])
+            if key not in items:
+                data = b''.join([data for data, _ in chunks])
+                kept = [data for data, game_state in chunks if not game_state]
+                if len(kept) == len(chunks):
+                    items[key] = OutboundItem(data, len(chunks), data,
+                                              len(chunks), resync)
+                else:
+                    items[key] = OutboundItem(data, len(chunks),
+                                              b''.join(kept), len(kept),
+                                              resync)
+            self.queues_out[connection_id].put(items[key])
+        self.resyncs = set()
+        self.pending_out = []
+
+
+
+class TestMessageDecoder(unittest.TestCase):
+
+    class FakeSocket:
+
+        def __init__(self, chunks=()):
+            self.chunks = list(chunks)
+            self.sent = b''
+
+        def send(self, data):
+            self.sent += data
+            return len(data)
+
+        def recv_into(self, buf):
+            if len(self.chunks) == 0:
+                return 0
+            chunk = self.chunks.pop(0)
+            buf[:len(chunk)] = chunk
+            return len(chunk)
+
+    def test_escapes(self):
+        messages = ['foo', '', 'a$b', 'a\\$', '\\\\$$', 'ü', '$']
+        sender = PlomSocket(self.FakeSocket())
+        for msg in messages:
+            sender.send(msg)
+        data = sender.socket.sent
+        self.assertEqual(data, b'foo$$a\\$b$a\\\\\\$$\\\\\\\\\\$\\$$'
+                               b'\xc3\xbc$\\$$')
+        for chunk_size in range(1, len(data) + 1):
+            chunks = [data[i:i + chunk_size]
+                      for i in range(0, len(data), chunk_size)]
+            receiver = PlomSocket(self.FakeSocket(chunks))
+            self.assertEqual(list(receiver.recv()), messages)
+
+    def test_bad_unicode(self):
+        receiver = PlomSocket(self.FakeSocket([b'\xc3$ok$\xc3', b'\xbc$']))
+        self.assertEqual(list(receiver.recv()), [None, 'ok', 'ü'])
+
+    def test_unfinished(self):
+        decoder = MessageDecoder()
+        self.assertEqual(list(decoder.feed(b'a\\')), [])
+        self.assertEqual(list(decoder.feed(b'$b')), [])
+        self.assertEqual(list(decoder.feed(b'$')), ['a$b'])
+
+
+
+class TestGameIO(unittest.TestCase):
+
+    def test_flush(self):
+        io = GameIO('/dev/null', None)
+        io.queues_out = {1: queue.Queue(), 2: queue.Queue()}
+        io.send('a', 1)
+        io.send('b$')
+        io.send('c', 2)
+        self.assertTrue(io.queues_out[1].empty())
+        io.flush()
+        self.assertEqual(io.queues_out[1].get_nowait()[:2], (b'a$b\\$$', 2))
+        self.assertEqual(io.queues_out[2].get_nowait()[:2], (b'b\\$$c$', 2))
+        self.assertTrue(io.queues_out[1].empty())
+        self.assertEqual(io.pending_out, [])
+        io.queues_out[3] = queue.Queue()
+        io.send('d')
+        io.send('e', 2)
+        io.send('f')
+        io.flush()
+        data_1 = io.queues_out[1].get_nowait().data
+        self.assertEqual(data_1, b'd$f$')
+        self.assertIs(data_1, io.queues_out[3].get_nowait().data)
+        self.assertEqual(io.queues_out[2].get_nowait()[:2], (b'd$e$f$', 3))
+
+    def test_journal_options(self):
+        from plomrogue.game import Game
+        io = GameIO('/dev/null', None, durability='fsync', sync_interval=2)
+        self.assertEqual((io.journal.durability, io.journal.sync_interval),
+                         ('fsync', 2))
+        game = Game('/dev/null', journal_options={'durability': 'none'})
+        self.assertEqual(game.io.journal.durability, 'none')
+        self.assertRaises(ArgError, GameIO, '/dev/null', None,
+                          durability='sometimes')
+
+    def test_resync(self):
+        from plomrogue.game import Game
+        with tempfile.TemporaryDirectory() as dir_name:
+            game = Game(os.path.join(dir_name, 'game'))
+            game.io.handle_input('GEN_WORLD Y:8,X:8 3')
+            io = game.io
+            io.queues_out = {1: queue.Queue(), 2: queue.Queue()}
+            io.gamestate_modes[1] = 'delta'
+            io.gamestate_modes[2] = 'delta'
+            game.send_gamestate()
+            io.flush()
+            io.queues_out[1].get_nowait()
+            io.queues_out[2].get_nowait()
+            game.send_gamestate()
+            io.send('SAVED "x"', 1)
+            io.resync(1)
+            self.assertNotIn(1, io.pending_out[0][0])
+            io.flush()
+            item = io.queues_out[1].get_nowait()
+            self.assertEqual(item.data.split(b' ')[0], b'SAVED')
+            self.assertIn(b'$GAME_STATE ', item.data)
+            self.assertEqual((item.kept, item.n_kept, item.resync),
+                             (b'SAVED "x"$', 1, True))
+            self.assertTrue(io.queues_out[2].get_nowait().data
+                            .startswith(b'GAME_STATE_DELTA '))
+
+    def test_stop(self):
+        io = GameIO('/dev/null', None)
+        io.journal.history = False
+        q = queue.Queue()
+        q.put(('ADD_QUEUE', 1, queue.Queue()))
+        q.put(('CALL', None, lambda: io.send('a', 1)))
+        q.put(('STOP', None))
+        q.put(('CALL', None, lambda: io.send('b', 1)))
+        queue_out = q.queue[0][2]
+        io.loop(q)
+        self.assertEqual(queue_out.get_nowait()[:2], (b'a$', 1))
+        self.assertEqual(queue_out.get_nowait()[:2], (b'b$', 1))
+
+    def test_write_in_background(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as dir_name:
+            file_name = os.path.join(dir_name, 'file')
+            io = GameIO(os.path.join(dir_name, 'game'), None)
+            io.journal.history = False
+            event = threading.Event()
+            results = []
+
+            def get_data():
+                event.wait()
+                return 'foo'
+
+            def write():
+                io.write_in_background(file_name, get_data, results.append)
+                with self.assertRaises(GameError):
+                    io.write_in_background(file_name, get_data, None)
+                self.assertFalse(os.path.exists(file_name))
+                event.set()
+
+            q = queue.Queue()
+            q.put(('CALL', None, write))
+            q.put(('STOP', None))
+            io.loop(q)
+            self.assertEqual(results, [None])
+            with open(file_name) as f:
+                self.assertEqual(f.read(), 'foo')
+            io.write_in_background(file_name, lambda: b'bar', results.append)
+            self.assertEqual(results, [None, None])
+
+
+
+class TestServer(unittest.TestCase):
+
+    def test_connection(self):
+
+        async def talk():
+            q = queue.Queue()
+            server = Server(q, 0)
+            tcp_server = await asyncio.start_server(server.handle,
+                                                    'localhost', 0)
+            port = tcp_server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('localhost', port)
+            writer.write(b'FOO\\$$BAR')
+            await writer.drain()
+            get = asyncio.get_running_loop().run_in_executor
+            add_queue = await get(None, q.get, True, 1)
+            self.assertEqual(add_queue[0], 'ADD_QUEUE')
+            self.assertEqual(await get(None, q.get, True, 1),
+                             ('COMMAND', add_queue[1], 'FOO$'))
+            threading.Thread(target=add_queue[2].put,
+                             args=(OutboundItem(b'A$', 1, b'A$', 1,
+                                                False),)).start()
+            self.assertEqual(await reader.readuntil(b'$'), b'A$')
+            writer.write(b'$QUEUE_STATS$QUIT$')
+            self.assertEqual(await reader.read(),
+                             b'QUEUE_STATS 1 0 0 2 0$BYE$')
+            self.assertEqual(await get(None, q.get, True, 1),
+                             ('COMMAND', add_queue[1], 'BAR'))
+            self.assertEqual(await get(None, q.get, True, 1),
+                             ('KILL_QUEUE', add_queue[1]))
+            writer.close()
+            tcp_server.close()
+            await tcp_server.wait_closed()
+
+        asyncio.run(talk())
+
+    def test_resync_overflow(self):
+
+        async def talk():
+            q = queue.Queue()
+            server = Server(q, 0, max_bytes=8)
+            tcp_server = await asyncio.start_server(server.handle,
+                                                    'localhost', 0)
+            port = tcp_server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('localhost', port)
+            get = asyncio.get_running_loop().run_in_executor
+            add_queue = await get(None, q.get, True, 1)
+            state = OutboundItem(b'GAME_STATE 1$', 1, b'', 0, False)
+            add_queue[2].put_nowait(state)
+            self.assertEqual(await get(None, q.get, True, 1),
+                             ('RESYNC', add_queue[1]))
+            add_queue[2].put_nowait(state._replace(resync=True))
+            try:
+                self.assertEqual(await reader.read(), b'')
+            except ConnectionError:
+                pass
+            self.assertEqual(await get(None, q.get, True, 1),
+                             ('KILL_QUEUE', add_queue[1]))
+            self.assertTrue(q.empty())
+            writer.close()
+            tcp_server.close()
+            await tcp_server.wait_closed()
+
+        asyncio.run(talk())
+
+    def test_gamestate_modes(self):
+        io = GameIO('/dev/null', None)
+        io.queues_out = {1: queue.Queue(), 2: queue.Queue()}
+        io.gamestate_modes[2] = 'frame'
+        self.assertEqual(io.get_receivers(None, 'lines'), [1])
+        self.assertEqual(io.get_receivers(2, 'lines'), [])
+        io.send('a', None, 'frame')
+        io.send('b', 1, 'frame')
+        io.flush()
+        self.assertTrue(io.queues_out[1].empty())
+        self.assertEqual(io.queues_out[2].get_nowait()[:2], (b'a$', 1))
+
+    def test_overflow(self):
+
+        async def fill():
+            overflowed = []
+            q = OutboundQueue(3, 8, overflowed.append)
+
+            def put(data, n_messages):
+                q.put_nowait(OutboundItem(data, n_messages, data, n_messages,
+                                          False))
+
+            put(b'a$b$', 2)
+            put(b'c$', 1)
+            self.assertEqual(overflowed, [])
+            put(b'd$', 1)
+            self.assertEqual(overflowed, [q])
+            self.assertEqual(await q.get(), b'a$b$c$d$')
+            put(b'e$f$g$h$', 4)
+            self.assertEqual(len(overflowed), 2)
+            self.assertEqual((q.n_messages, q.n_bytes, q.peak_bytes),
+                             (4, 8, 8))
+
+        asyncio.run(fill())
+
+    def test_drop_game_states(self):
+
+        async def fill():
+            q = OutboundQueue(5, 100, OutboundQueue.drop_game_states)
+            q.put_nowait(OutboundItem(b'S1$R1$', 2, b'R1$', 1, False))
+            q.put_nowait(OutboundItem(b'S2$', 1, b'', 0, False))
+            q.put_nowait(OutboundItem(b'S3$S4$R2$', 3, b'R2$', 1, False))
+            self.assertEqual((q.n_messages, q.n_bytes), (2, 6))
+            q.put_nowait(OutboundItem(b'S5$R3$', 2, b'R3$', 1, False))
+            q.put_nowait(OutboundItem(b'F$', 1, b'', 0, True))
+            q.put_nowait(OutboundItem(b'S6$', 1, b'', 0, False))
+            self.assertEqual(await q.get(), b'R1$R2$R3$F$S6$')
+            self.assertFalse(q.awaiting_resync)
+
+        asyncio.run(fill())
@@ -0,0 +1,387 @@
+import os
+import tempfile
+import time
+import unittest
+from plomrogue.errors import ArgError
+
+
+
+class Journal:
+    """Append command lines to a game file kept open, in batches.
+
+    Lines passed to write() are only buffered, to be written out all
+    at once on commit(). How durable a commit is depends on
+    durability: 'none' leaves the data in Python's file buffer,
+    'flush' (the default) hands it to the operating system, and
+    'fsync' additionally forces it to disk – but at most once every
+    sync_interval seconds, so that many commits share one fsync.
+
+    To keep the file from growing with the whole game history, it can
+    be compact()ed into a snapshot of the game state plus the lines
+    committed after it.
+
+    Unless history is False, the recent history is kept nonetheless:
+    all lines are also appended to file_name plus '.history', and a
+    sidecar index at file_name plus '.index' maps turns and snapshots
+    to byte offsets in it (see index_turn(), index_snapshot() and
+    get_checkpoint()). Both are committed along with the lines, but
+    never fsync'd. Offsets count from the start of the game, even
+    once the history has been trim_history()ed to the last few
+    snapshots; the index then starts with a 'START' line giving the
+    offset that the history file starts at.
+
+    """
+
+    def __init__(self, file_name, durability='flush', sync_interval=0.05,
+                 history=True):
+        self.set_durability(durability, sync_interval)
+        self.file_name = file_name
+        self.history = history
+        self.history_file_name = file_name + '.history'
+        self.index_file_name = file_name + '.index'
+        self.file = None
+        self.history_file = None
+        self.index_file = None
+        self.lines = []
+        self.n_bytes = 0
+        self.history_offset = None
+        self.history_start = None
+        self.index_lines = []
+        self.unsynced = False
+        self.last_sync = float('-inf')
+        self.n_commits = 0
+        self.n_lines = 0
+        self.n_lines_compacted = 0
+        self.n_syncs = 0
+        self.commit_time = 0
+        self.max_commit_time = 0
+
+    def set_durability(self, durability, sync_interval=None):
+        """Set durability policy of commits, and sync_interval if given."""
+        if durability not in {'none', 'flush', 'fsync'}:
+            raise ArgError('Unknown journal durability: %s' % durability)
+        self.durability = durability
+        if sync_interval is not None:
+            self.sync_interval = sync_interval
+
+    def write(self, line):
+        """Buffer line (without trailing newline) for next commit()."""
+        self.lines += [line + '\n']
+        self.n_bytes += len(line.encode()) + 1
+
+    def get_history_start(self):
+        """Return offset in history that the history file starts at."""
+        if self.history_start is None:
+            self.history_start = self.read_index()[0]
+        return self.history_start
+
+    def get_history_offset(self):
+        """Return offset in history that the lines written lead to."""
+        if self.history_offset is None:
+            self.history_offset = self.get_history_start()
+            if os.path.exists(self.history_file_name):
+                self.history_offset += \
+                    os.path.getsize(self.history_file_name)
+        return self.history_offset + self.n_bytes
+
+    def index_turn(self, turn):
+        """Index that the history written so far leads to turn."""
+        if self.history:
+            self.index_lines += ['TURN %s %s\n' %
+                                 (turn, self.get_history_offset())]
+
+    def index_snapshot(self, snapshot_file_name, offset):
+        """Index snapshot_file_name as the state at history offset."""
+        if self.history:
+            self.index_lines += ['SNAPSHOT %s %s\n' %
+                                 (offset, os.path.basename(snapshot_file_name))]
+
+    def read_index(self):
+        """Return history start offset, and indexed turns and snapshots.
+
+        Turns are listed as (turn, offset) tuples, snapshots as
+        (offset, file name) tuples, both in order of indexing. Only
+        what is committed is read.
+
+        """
+        start = 0
+        turns = []
+        snapshots = []
+        if os.path.exists(self.index_file_name):
+            with open(self.index_file_name) as f:
+                for line in f:
+                    fields = line.rstrip('\n').split(' ', 2)
+                    if fields[0] == 'START':
+                        start = int(fields[1])
+                    elif fields[0] == 'TURN':
+                        turns += [(int(fields[1]), int(fields[2]))]
+                    elif fields[0] == 'SNAPSHOT':
+                        snapshots += [(int(fields[1]), os.path.join(
+                            os.path.dirname(self.file_name), fields[2]))]
+        return start, turns, snapshots
+
+    def get_checkpoint(self, turn):
+        """Return where to restore the latest indexed turn up to turn from.
+
+        That is a tuple of the turn found, the file name of the last
+        snapshot indexed before it in the history (or None to start
+        from an empty game), and the history offsets at which to
+        start and to stop replaying. Turns the game only went through
+        within a single command are not indexed. Raises ArgError if
+        no turn up to turn is indexed.
+
+        """
+        self.commit()
+        _, turns, snapshots = self.read_index()
+        found = None
+        for indexed in turns:
+            if indexed[0] <= turn and (found is None or indexed > found):
+                found = indexed
+        if found is None:
+            raise ArgError('No turn up to %s in history.' % turn)
+        found_turn, end = found
+        start, snapshot_file_name = 0, None
+        for offset, file_name in snapshots:
+            if start <= offset <= end:
+                start, snapshot_file_name = offset, file_name
+        return found_turn, snapshot_file_name, start, end
+
+    def trim_history(self, n_snapshots):
+        """Drop history before the oldest of the last n_snapshots snapshots.
+
+        Also drops the index entries for it. Returns the file names of
+        the snapshots indexed before, which are no longer needed.
+
+        """
+        self.commit()
+        history_start, turns, snapshots = self.read_index()
+        if len(snapshots) <= n_snapshots:
+            return []
+        start = snapshots[-n_snapshots][0]
+        if start <= history_start:
+            return []
+        with open(self.history_file_name, 'rb') as f:
+            f.seek(start - history_start)
+            history = f.read()
+        index = ['START %s\n' % start]
+        index += ['TURN %s %s\n' % (turn, offset)
+                  for turn, offset in turns if offset >= start]
+        index += ['SNAPSHOT %s %s\n' % (offset, os.path.basename(file_name))
+                  for offset, file_name in snapshots if offset >= start]
+        for f in (self.history_file, self.index_file):
+            if f is not None:
+                f.close()
+        self.history_file = None
+        self.index_file = None
+        for file_name, data in ((self.history_file_name, history),
+                                (self.index_file_name,
+                                 ''.join(index).encode())):
+            with open(file_name + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(file_name + '.tmp', file_name)
+        self.history_start = start
+        return [file_name for offset, file_name in snapshots
+                if offset < start]
+
+    def commit(self):
+        """Write out buffered lines, and flush/fsync as durability demands."""
+        start = time.perf_counter()
+        if len(self.lines) > 0:
+            if self.file is None:
+                self.file = open(self.file_name, 'a')
+            data = ''.join(self.lines)
+            self.file.write(data)
+            if self.history:
+                if self.history_file is None:
+                    self.get_history_offset()
+                    self.history_file = open(self.history_file_name, 'a',
+                                             encoding='utf-8')
+                self.history_file.write(data)
+                self.history_offset += self.n_bytes
+            self.n_bytes = 0
+            self.n_commits += 1
+            self.n_lines += len(self.lines)
+            self.lines = []
+            if self.durability != 'none':
+                self.file.flush()
+                if self.history_file is not None:
+                    self.history_file.flush()
+            self.unsynced = self.durability == 'fsync'
+        if len(self.index_lines) > 0:
+            if self.index_file is None:
+                self.index_file = open(self.index_file_name, 'a')
+            self.index_file.write(''.join(self.index_lines))
+            self.index_lines = []
+            if self.durability != 'none':
+                self.index_file.flush()
+        if self.unsynced and start - self.last_sync >= self.sync_interval:
+            os.fsync(self.file.fileno())
+            self.unsynced = False
+            self.last_sync = time.perf_counter()
+            self.n_syncs += 1
+        duration = time.perf_counter() - start
+        self.commit_time += duration
+        self.max_commit_time = max(self.max_commit_time, duration)
+
+    def get_offset(self):
+        """Return byte length of the file as of the last commit()."""
+        if self.file is None:
+            if os.path.exists(self.file_name):
+                return os.path.getsize(self.file_name)
+            return 0
+        return self.file.tell()
+
+    def compact(self, snapshot_lines, offset):
+        """Replace file with snapshot_lines plus what follows offset.
+
+        The snapshot_lines are expected to be commands rebuilding the
+        game state as it was when the file was offset bytes long (see
+        get_offset()), so replaying the new file yields the same
+        state as replaying the old one. The new file is written and
+        fsync'd under a temporary name first, then atomically moved
+        into place, so a crash leaves either the old or the new file.
+
+        """
+        self.commit()
+        if self.file is not None:
+            self.file.flush()
+        with open(self.file_name, 'a+') as f:
+            f.seek(offset)
+            tail = f.read()
+        tmp_file_name = self.file_name + '.tmp'
+        with open(tmp_file_name, 'w') as f:
+            f.write(''.join([line + '\n' for line in snapshot_lines]))
+            f.write(tail)
+            f.flush()
+            os.fsync(f.fileno())
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        os.replace(tmp_file_name, self.file_name)
+        self.unsynced = False
+        self.n_lines_compacted = self.n_lines
+
+    def get_sync_timeout(self):
+        """Return seconds until an fsync is due, or None if none is."""
+        if not self.unsynced:
+            return None
+        return max(0, self.last_sync + self.sync_interval -
+                   time.perf_counter())
+
+    def get_stats(self):
+        """Return 'JOURNAL_STATS' message on commits so far.
+
+        Its fields are the number of commits, of lines committed, of
+        fsyncs, and the mean and maximum time spent per commit() in
+        microseconds.
+
+        """
+        mean = 0 if self.n_commits == 0 else self.commit_time / self.n_commits
+        return 'JOURNAL_STATS %s %s %s %d %d' % (self.n_commits, self.n_lines,
+                                                 self.n_syncs, mean * 1e6,
+                                                 self.max_commit_time * 1e6)
+
+    def close(self):
+        self.commit()
+        if self.file is not None:
+            if self.unsynced:
+                os.fsync(self.file.fileno())
+                self.unsynced = False
+            self.file.close()
+            self.file = None
+        for f in (self.history_file, self.index_file):
+            if f is not None:
+                f.close()
+        self.history_file = None
+        self.index_file = None
+
+
+
+class TestJournal(unittest.TestCase):
+
+    def test_commit(self):
+        with tempfile.TemporaryDirectory() as dir_name:
+            file_name = os.path.join(dir_name, 'game')
+            journal = Journal(file_name, 'fsync', sync_interval=3600)
+            journal.write('FOO')
+            journal.write('BAR "1 2"')
+            self.assertFalse(os.path.exists(file_name))
+            journal.commit()
+            journal.write('BAZ')
+            journal.commit()
+            with open(file_name) as f:
+                self.assertEqual(f.read(), 'FOO\nBAR "1 2"\nBAZ\n')
+            self.assertEqual(journal.get_stats().split()[1:4],
+                             ['2', '3', '1'])
+            self.assertGreater(journal.get_sync_timeout(), 0)
+            journal.close()
+            self.assertIsNone(journal.get_sync_timeout())
+
+    def test_compact(self):
+        with tempfile.TemporaryDirectory() as dir_name:
+            file_name = os.path.join(dir_name, 'game')
+            journal = Journal(file_name)
+            journal.write('A')
+            journal.write('B')
+            journal.commit()
+            offset = journal.get_offset()
+            journal.write('C')
+            journal.compact(['AB1', 'AB2'], offset)
+            journal.write('D')
+            journal.commit()
+            with open(file_name) as f:
+                self.assertEqual(f.read(), 'AB1\nAB2\nC\nD\n')
+            self.assertEqual(journal.n_lines_compacted, 3)
+            journal.close()
+
+    def test_checkpoint(self):
+        with tempfile.TemporaryDirectory() as dir_name:
+            file_name = os.path.join(dir_name, 'game')
+            journal = Journal(file_name)
+            self.assertRaises(ArgError, journal.get_checkpoint, 0)
+            journal.write('A')
+            journal.index_turn(0)
+            journal.write('B')
+            journal.index_turn(3)
+            journal.commit()
+            journal.index_snapshot(file_name + '.snapshot.1', 4)
+            journal.write('C')
+            journal.index_turn(6)
+            journal.compact(['ABC'], journal.get_offset())
+            journal.write('D')
+            journal.index_turn(9)
+            self.assertEqual(journal.get_checkpoint(2), (0, None, 0, 2))
+            self.assertEqual(journal.get_checkpoint(8),
+                             (6, file_name + '.snapshot.1', 4, 6))
+            self.assertEqual(journal.get_checkpoint(100)[1:],
+                             (file_name + '.snapshot.1', 4, 8))
+            with open(journal.history_file_name) as f:
+                self.assertEqual(f.read(), 'A\nB\nC\nD\n')
+            journal.close()
+
+    def test_trim_history(self):
+        with tempfile.TemporaryDirectory() as dir_name:
+            file_name = os.path.join(dir_name, 'game')
+            journal = Journal(file_name)
+            for i, line in enumerate(['A', 'B', 'C']):
+                journal.write(line)
+                journal.index_turn(i)
+                journal.commit()
+                journal.index_snapshot('%s.snapshot.%s' % (file_name, i),
+                                       journal.get_history_offset())
+            self.assertEqual(journal.trim_history(3), [])
+            self.assertEqual(journal.trim_history(2),
+                             [file_name + '.snapshot.0'])
+            journal.write('D')
+            journal.index_turn(3)
+            self.assertEqual(journal.get_history_offset(), 8)
+            self.assertEqual(journal.get_checkpoint(5),
+                             (3, file_name + '.snapshot.2', 6, 8))
+            self.assertRaises(ArgError, journal.get_checkpoint, 0)
+            journal.close()
+            with open(journal.history_file_name) as f:
+                self.assertEqual(f.read(), 'C\nD\n')
+            journal_2 = Journal(file_name)
+            self.assertEqual(journal_2.get_history_offset(), 8)
+            self.assertEqual(journal_2.get_checkpoint(1)[1:],
+                             (file_name + '.snapshot.1', 4, 4))
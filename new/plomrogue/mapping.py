@@ -1,5 +1,9 @@
+import unittest
 from plomrogue.errors import ArgError
+import array
+import bisect
 import collections
+import math
 
 
 
@@ -16,22 +20,39 @@ class YX(collections.namedtuple('YX', ('y', 'x'))):
 
 
 
+# Cache of translation tables built by get_char_table.
+char_tables = {}
+
+
+def get_char_table(chars, c_in, c_out):
+    """Return bytes.translate table mapping chars to c_in, all else to c_out."""
+    key = (chars, c_in, c_out)
+    if key not in char_tables:
+        char_tables[key] = bytes([ord(c_in) if chr(i) in chars else ord(c_out)
+                                  for i in range(256)])
+    return char_tables[key]
+
+
+
 class Map:
+    """Rectangular grid of single-character cells.
+
+    Cells are stored row by row in the bytearray .terrain, so that
+    single-cell writes are O(1) and whole rows or regions can be
+    copied or filled in bulk; cell characters must thus be ASCII.
+
+    """
 
     def __init__(self, size=YX(0, 0), init_char = '?', start_indented=True):
         self.size = size
-        self.terrain = init_char*self.size_i
+        self.terrain = bytearray(init_char.encode()) * self.size_i
         self.start_indented = start_indented
 
     def __getitem__(self, yx):
-        return self.terrain[self.get_position_index(yx)]
+        return chr(self.terrain[self.get_position_index(yx)])
 
     def __setitem__(self, yx, c):
-        pos_i = self.get_position_index(yx)
-        if type(c) == str:
-            self.terrain = self.terrain[:pos_i] + c + self.terrain[pos_i + 1:]
-        else:
-            self.terrain[pos_i] = c
+        self.terrain[self.get_position_index(yx)] = ord(c)
 
     def __iter__(self):
         """Iterate over YX position coordinates."""
@@ -43,6 +64,49 @@ class Map:
     def size_i(self):
         return self.size.y * self.size.x
 
+    def fill(self, data, start=YX(0, 0), size=None):
+        """Write data into rectangle of size at start, row by row.
+
+        data is either a single character to set all of the rectangle's
+        cells to, or bytes holding one character per cell. If size is
+        None, the rectangle reaches to the map's bottom right corner.
+        Raises ArgError if the rectangle does not fit into the map, or
+        data does not fit the rectangle.
+
+        """
+        if size is None:
+            size = self.size - start
+        if size.y < 0 or size.x < 0 or \
+           start.y < 0 or start.y + size.y > self.size.y:
+            raise ArgError('fill region out of map bounds')
+        if type(data) == str:
+            rows = [data.encode() * size.x] * size.y
+        else:
+            if len(data) != size.y * size.x:
+                raise ArgError('fill data does not fit region')
+            rows = [data[i * size.x:(i + 1) * size.x] for i in range(size.y)]
+        for y, row in enumerate(rows):
+            self.set_row_slice(start.y + y, start.x, row)
+
+    def get_row_slice(self, y, start=0, end=None):
+        """Return copy of row y from x=start to (excluding) x=end."""
+        if end is None:
+            end = self.size.x
+        row_start = y * self.size.x
+        return self.terrain[row_start + start:row_start + end]
+
+    def set_row_slice(self, y, start, data):
+        """Write bytes data into row y, starting at x=start.
+
+        Raises ArgError if data would not fit into the row.
+
+        """
+        if not 0 <= y < self.size.y or start < 0 or \
+           start + len(data) > self.size.x:
+            raise ArgError('row slice out of map bounds')
+        row_start = y * self.size.x + start
+        self.terrain[row_start:row_start + len(data)] = data
+
     def set_line(self, y, line):
         height_map = self.size.y
         width_map = self.size.x
@@ -51,8 +115,10 @@ class Map:
         width_line = len(line)
         if width_line > width_map:
             raise ArgError('too large map line width %s' % width_line)
-        self.terrain = self.terrain[:y * width_map] + line +\
-                       self.terrain[(y + 1) * width_map:]
+        try:
+            self.set_row_slice(y, 0, line.encode('ascii'))
+        except UnicodeEncodeError:
+            raise ArgError('map line contains non-ASCII characters')
 
     def get_position_index(self, yx):
         return yx.y * self.size.x + yx.x
@@ -60,12 +126,51 @@ class Map:
     def lines(self):
         width = self.size.x
         for y in range(self.size.y):
-            yield (y, self.terrain[y * width:(y + 1) * width])
+            yield (y, self.terrain[y * width:(y + 1) * width].decode())
+
+    def get_bits(self, chars):
+        """Return int with bit i set for each cell i containing one of chars.
+
+        This packs the map into a bitset in bulk: translate it into a
+        string of binary digits, lowest cell last, and parse that.
+
+        """
+        if self.size_i == 0:
+            return 0
+        binary = self.terrain.translate(get_char_table(chars, '1', '0'))
+        return int(binary[::-1], 2)
+
+    def masked(self, bits, blank=' '):
+        """Return copy of map with cells not set in bitset bits as blank.
+
+        Works in bulk by treating terrain, bitset-derived byte mask and
+        blanks as one big int each.
+
+        """
+        m = Map(self.size, blank, self.start_indented)
+        if self.size_i == 0:
+            return m
+        binary = ('{:0%sb}' % self.size_i).format(bits)[::-1].encode()
+        mask = int.from_bytes(binary.translate(get_char_table('1', '\xff',
+                                                              '\x00')),
+                              'little')
+        full = (1 << (8 * self.size_i)) - 1
+        terrain = int.from_bytes(self.terrain, 'little') & mask
+        blanks = int.from_bytes(m.terrain, 'little') & (full ^ mask)
+        m.terrain[:] = (terrain | blanks).to_bytes(self.size_i, 'little')
+        return m
 
 
 
 class MapGeometry():
 
+    def __init__(self):
+        # Direction IDs are indices into .directions, which is sorted.
+        self.directions = tuple(self.get_directions())
+        # Least recently used neighbor tables are dropped beyond this many.
+        self.neighbors_i_max = 8
+        self.neighbors_i = collections.OrderedDict()
+
     def get_directions(self):
         directions = []
         for name in dir(self):
@@ -73,21 +178,99 @@ class MapGeometry():
                 directions += [name[5:]]
         return directions
 
-    def get_neighbors(self, pos, map_size, start_indented=True):
-        neighbors = {}
-        if not hasattr(self, 'neighbors_to'):
-            self.neighbors_to = {}
-        if not map_size in self.neighbors_to:
-            self.neighbors_to[map_size] = {}
-        if not start_indented in self.neighbors_to[map_size]:
-            self.neighbors_to[map_size][start_indented] = {}
-        if pos in self.neighbors_to[map_size][start_indented]:
-            return self.neighbors_to[map_size][start_indented][pos]
-        for direction in self.get_directions():
-            neighbors[direction] = self.move(pos, direction, map_size,
-                                             start_indented)
-        self.neighbors_to[map_size][start_indented][pos] = neighbors
-        return neighbors
+    def get_neighbors_i(self, map_size, start_indented=True):
+        """Return flat array of neighbor position indices in map of map_size.
+
+        For position index i and direction ID d, the neighbor's
+        position index is found at i * len(self.directions) + d, or
+        -1 if it lies outside the map. Results are cached per map size
+        and indentation, for the last .neighbors_i_max of these used.
+
+        As moves only depend on the parity of a row, rows between the
+        map's first two and its last one are not calculated move by
+        move, but shifted from the row two above.
+
+        """
+        key = (map_size, start_indented)
+        if key in self.neighbors_i:
+            self.neighbors_i.move_to_end(key)
+            return self.neighbors_i[key]
+        movers = [getattr(self, 'move_' + direction)
+                  for direction in self.directions]
+        shift = 2 * map_size.x
+        rows = []
+        for y in range(map_size.y):
+            if 3 <= y < map_size.y - 1:
+                rows += [array.array('l', [i + shift if i >= 0 else -1
+                                           for i in rows[y - 2]])]
+                continue
+            row = array.array('l')
+            for x in range(map_size.x):
+                for mover in movers:
+                    neighbor = mover(YX(y, x), start_indented)
+                    if 0 <= neighbor.y < map_size.y and \
+                       0 <= neighbor.x < map_size.x:
+                        row.append(neighbor.y * map_size.x + neighbor.x)
+                    else:
+                        row.append(-1)
+            rows += [row]
+        neighbors_i = array.array('l')
+        for row in rows:
+            neighbors_i += row
+        self.neighbors_i[key] = neighbors_i
+        while len(self.neighbors_i) > self.neighbors_i_max:
+            self.neighbors_i.popitem(last=False)
+        return neighbors_i
+
+    def get_dijkstra_map(self, map_, targets, passable='.'):
+        """Return per position index of map_ the steps to nearest of targets.
+
+        Runs a breadth-first search from all target positions at once
+        over the cells of map_ containing passable. Positions from
+        which no target can be reached get None.
+
+        """
+        neighbors_i = self.get_neighbors_i(map_.size, map_.start_indented)
+        n_directions = len(self.directions)
+        passable = ord(passable)
+        dijkstra_map = [None] * map_.size_i
+        queue = []
+        for target in targets:
+            i = map_.get_position_index(target)
+            if dijkstra_map[i] is None:
+                dijkstra_map[i] = 0
+                queue += [i]
+        for i in queue:  # Iterates into what's appended during iteration.
+            distance = dijkstra_map[i] + 1
+            for neighbor_i in neighbors_i[i * n_directions:
+                                          (i + 1) * n_directions]:
+                if neighbor_i >= 0 and dijkstra_map[neighbor_i] is None and \
+                   map_.terrain[neighbor_i] == passable:
+                    dijkstra_map[neighbor_i] = distance
+                    queue += [neighbor_i]
+        return dijkstra_map
+
+    def get_dijkstra_direction(self, map_, dijkstra_map, pos):
+        """Return direction from pos to its neighbor nearest to a target.
+
+        Of equally near neighbors, chooses the first in direction
+        order. Returns None if no neighbor can reach any target.
+
+        """
+        neighbors_i = self.get_neighbors_i(map_.size, map_.start_indented)
+        n_directions = len(self.directions)
+        start = map_.get_position_index(pos) * n_directions
+        n = None
+        target_direction = None
+        for direction_id in range(n_directions):
+            neighbor_i = neighbors_i[start + direction_id]
+            if neighbor_i < 0:
+                continue
+            n_new = dijkstra_map[neighbor_i]
+            if n_new is not None and (n is None or n_new < n):
+                n = n_new
+                target_direction = self.directions[direction_id]
+        return target_direction
 
     def undouble_coordinate(self, maps_size, coordinate):
         y = maps_size.y * coordinate[0].y + coordinate[1].y
@@ -102,15 +285,37 @@ class MapGeometry():
         return self.undouble_coordinate(maps_size, pos) - offset
 
     def get_view(self, maps_size, get_map, radius, view_offset):
-        m = Map(size=YX(radius*2+1, radius*2+1),
-                start_indented=(view_offset.y % 2 == 0))
-        for pos in m:
-            seen_pos = self.correct_double_coordinate(maps_size, (0,0),
-                                                      pos + view_offset)
-            seen_map = get_map(seen_pos[0], False)
-            if seen_map is None:
-                seen_map = Map(size=maps_size)
-            m[pos] = seen_map[seen_pos[1]]
+        return self.get_region(maps_size, get_map, view_offset,
+                               YX(radius*2+1, radius*2+1))
+
+    def get_region(self, maps_size, get_map, offset, size):
+        """Return map of size cells from offset on, assembled from get_map.
+
+        Copies the row segments of each map (chunk) that overlaps the
+        region in bulk. Cells from maps that get_map does not provide
+        stay at the region's default unknown-terrain '?'.
+
+        """
+        m = Map(size=size, start_indented=(offset.y % 2 == 0))
+        region_end = offset + m.size
+        for big_y in range(offset.y // maps_size.y,
+                           (region_end.y - 1) // maps_size.y + 1):
+            for big_x in range(offset.x // maps_size.x,
+                               (region_end.x - 1) // maps_size.x + 1):
+                seen_map = get_map(YX(big_y, big_x), False)
+                if seen_map is None:
+                    continue
+                map_start = YX(big_y * maps_size.y, big_x * maps_size.x)
+                map_end = map_start + maps_size
+                top = max(offset.y, map_start.y)
+                bottom = min(region_end.y, map_end.y)
+                left = max(offset.x, map_start.x)
+                right = min(region_end.x, map_end.x)
+                for y in range(top, bottom):
+                    row = seen_map.get_row_slice(y - map_start.y,
+                                                 left - map_start.x,
+                                                 right - map_start.x)
+                    m.set_row_slice(y - offset.y, left - offset.x, row)
         return m
 
     def correct_double_coordinate(self, map_size, big_yx, little_yx):
@@ -187,83 +392,110 @@ class MapGeometryHex(MapGeometryWithLeftRightMoves):
 
 
 class FovMap(Map):
+    # Process-wide cache of .get_cone_table results, as these only depend
+    # on FovMap type, map size, indentation and FOV center.
+    cone_tables = {}
 
     def __init__(self, source_map, center):
         self.source_map = source_map
         self.size = self.source_map.size
         self.fov_radius = (self.size.y / 2) - 0.5
         self.start_indented = source_map.start_indented
-        self.terrain = '?' * self.size_i
+        self.terrain = bytearray(b'?') * self.size_i
         self[center] = '.'
-        self.shadow_cones = []
-        self.circle_out(center, self.shadow_process_hex)
+        self.shadow_cones_right = []
+        self.shadow_cones_left = []
+        for pos_i, cones in self.get_cone_table(center):
+            self.shadow_process_hex(pos_i, cones)
+
+    def get_cone_table(self, center):
+        """Return sequence of (position index, cones) to circle out from center.
+
+        Lists all positions reachable by .circle_out from center in
+        circling order, with the one (or, if crossing the circle's
+        zero point, two) shadow cones covered by each. As this is
+        independent of the source map's content, each table is only
+        calculated once and then cached in FovMap.cone_tables.
+
+        """
+        key = (self.__class__, self.size, self.start_indented, center)
+        if key in self.cone_tables:
+            return self.cone_tables[key]
+        table = []
+
+        def add_to_table(yx, distance_to_center, dir_i, dir_progress):
+            cones = self.get_cones(distance_to_center, dir_i, dir_progress)
+            table.append((self.get_position_index(yx), cones))
+
+        self.circle_out(center, add_to_table)
+        self.cone_tables[key] = tuple(table)
+        return self.cone_tables[key]
 
-    def shadow_process_hex(self, yx, distance_to_center, dir_i, dir_progress):
-        # Possible optimization: If no shadow_cones yet and self[yx] == '.',
-        # skip all.
-        CIRCLE = 360  # Since we'll float anyways, number is actually arbitrary.
-
-        def correct_arm(arm):
-            if arm < 0:
-                arm += CIRCLE
-            return arm
-
-        def in_shadow_cone(new_cone):
-            for old_cone in self.shadow_cones:
-                if old_cone[0] >= new_cone[0] and \
-                    new_cone[1] >= old_cone[1]:
-                    #print('DEBUG shadowed by:', old_cone)
-                    return True
-                # We might want to also shade hexes whose middle arm is inside a
-                # shadow cone for a darker FOV. Note that we then could not for
-                # optimization purposes rely anymore on the assumption that a
-                # shaded hex cannot add growth to existing shadow cones.
-            return False
-
-        def merge_cone(new_cone):
-            import math
-            for old_cone in self.shadow_cones:
-                if new_cone[0] > old_cone[0] and \
-                    (new_cone[1] < old_cone[0] or
-                     math.isclose(new_cone[1], old_cone[0])):
-                    #print('DEBUG merging to', old_cone)
-                    old_cone[0] = new_cone[0]
-                    #print('DEBUG merged cone:', old_cone)
-                    return True
-                if new_cone[1] < old_cone[1] and \
-                    (new_cone[0] > old_cone[1] or
-                     math.isclose(new_cone[0], old_cone[1])):
-                    #print('DEBUG merging to', old_cone)
-                    old_cone[1] = new_cone[1]
-                    #print('DEBUG merged cone:', old_cone)
-                    return True
-            return False
-
-        def eval_cone(cone):
-            #print('DEBUG CONE', cone, '(', step_size, distance_to_center, number_steps, ')')
-            if in_shadow_cone(cone):
-                return
-            self[yx] = '.'
-            if self.source_map[yx] != '.':
-                #print('DEBUG throws shadow', cone)
-                unmerged = True
-                while merge_cone(cone):
-                    unmerged = False
-                if unmerged:
-                    self.shadow_cones += [cone]
-
-        #print('DEBUG', yx)
-        step_size = (CIRCLE/len(self.circle_out_directions)) / distance_to_center
+    @property
+    def circle(self):
+        """Integer size of full circle for exact cone arithmetic.
+
+        Cones are measured in units so that all cone arms at each
+        possible distance from the center are integers: a circle
+        divided into one step per circle_out_direction, each divided
+        by every distance up to fov_radius, and each of these steps
+        halved.
+
+        """
+        steps_per_arc = 1
+        for distance in range(1, int(self.fov_radius) + 1):
+            steps_per_arc = steps_per_arc * distance // \
+                            math.gcd(steps_per_arc, distance)
+        return len(self.circle_out_directions) * steps_per_arc * 2
+
+    def get_cones(self, distance_to_center, dir_i, dir_progress):
+        circle = self.circle
+        step_size = circle // len(self.circle_out_directions) \
+                    // distance_to_center
         number_steps = dir_i * distance_to_center + dir_progress
-        left_arm = correct_arm(-(step_size/2) - step_size*number_steps)
-        right_arm = correct_arm(left_arm - step_size)
-        # Optimization potential: left cone could be derived from previous
-        # right cone. Better even: Precalculate all cones.
+        left_arm = (-(step_size // 2) - step_size * number_steps) % circle
+        right_arm = (left_arm - step_size) % circle
         if right_arm > left_arm:
-            eval_cone([left_arm, 0])
-            eval_cone([CIRCLE, right_arm])
-        else:
-            eval_cone([left_arm, right_arm])
+            return ((left_arm, 0), (circle, right_arm))
+        return ((left_arm, right_arm),)
+
+    def in_shadow_cone(self, new_cone):
+        """Return whether new_cone lies completely in a shadow cone.
+
+        Shadow cones are kept as disjoint arm intervals sorted by their
+        right arms in .shadow_cones_right (with the respective left
+        arms in .shadow_cones_left), so we only need to check the one
+        starting right of or at new_cone's right arm.
+
+        """
+        # We might want to also shade hexes whose middle arm is inside a
+        # shadow cone for a darker FOV. Note that we then could not for
+        # optimization purposes rely anymore on the assumption that a
+        # shaded hex cannot add growth to existing shadow cones.
+        i = bisect.bisect_right(self.shadow_cones_right, new_cone[1]) - 1
+        return i >= 0 and self.shadow_cones_left[i] >= new_cone[0]
+
+    def merge_cone(self, new_cone):
+        """Add new_cone to shadow cones, merge with ones it touches."""
+        left_arm, right_arm = new_cone
+        start = bisect.bisect_left(self.shadow_cones_left, right_arm)
+        end = bisect.bisect_right(self.shadow_cones_right, left_arm)
+        if start < end:
+            right_arm = min(right_arm, self.shadow_cones_right[start])
+            left_arm = max(left_arm, self.shadow_cones_left[end - 1])
+        self.shadow_cones_right[start:end] = [right_arm]
+        self.shadow_cones_left[start:end] = [left_arm]
+
+    def shadow_process_hex(self, pos_i, cones):
+        # Possible optimization: If no shadow cones yet and self[yx] == '.',
+        # skip all.
+        for cone in cones:
+            if self.in_shadow_cone(cone):
+                continue
+            self.terrain[pos_i] = ord('.')
+            if self.source_map.terrain[pos_i] != ord('.'):
+                #print('DEBUG throws shadow', cone)
+                self.merge_cone(cone)
 
     def basic_circle_out_move(self, pos, direction):
         """Move position pos into direction. Return whether still in map."""
@@ -329,3 +561,152 @@ class FovMapSquare(FovMap):
         self.basic_circle_out_move(yx, direction[0])
         return self.basic_circle_out_move(yx, direction[1])
 
+
+
+class TestMap(unittest.TestCase):
+
+    def test_bits(self):
+        m = Map(YX(2, 3))
+        m.set_line(0, '.x~')
+        m.set_line(1, '~..')
+        self.assertEqual(m.get_bits('.'), 0b110001)
+        self.assertEqual(m.get_bits('.~'), 0b111101)
+        masked = m.masked(0b100101)
+        self.assertEqual(list(masked.lines()), [(0, '. ~'), (1, '  .')])
+        self.assertEqual(Map().get_bits('.'), 0)
+
+    def test_row_slice(self):
+        m = Map(YX(2, 3))
+        m.set_row_slice(1, 1, b'..')
+        self.assertEqual(m.get_row_slice(1), bytearray(b'?..'))
+        for y, start, data in ((1, 2, b'..'), (2, 0, b'.'), (0, -1, b'.')):
+            with self.assertRaises(ArgError):
+                m.set_row_slice(y, start, data)
+        self.assertEqual(len(m.terrain), m.size_i)
+
+    def test_fill(self):
+        m = Map(YX(3, 4))
+        m.fill('.', YX(1, 1), YX(2, 2))
+        m.fill(b'~x', YX(0, 2), YX(1, 2))
+        self.assertEqual([line for _, line in m.lines()],
+                         ['??~x', '?..?', '?..?'])
+        for data, start, size in (('.', YX(2, 0), YX(2, 1)),
+                                  ('.', YX(0, 3), YX(1, 2)),
+                                  ('.', YX(-1, 0), None),
+                                  (b'...', YX(0, 0), YX(1, 2))):
+            with self.assertRaises(ArgError):
+                m.fill(data, start, size)
+        self.assertEqual(len(m.terrain), m.size_i)
+
+
+
+class TestMapGeometry(unittest.TestCase):
+
+    def test_neighbors_i(self):
+        geometry = MapGeometryHex()
+        geometry.neighbors_i_max = 2
+        n_directions = len(geometry.directions)
+        for size in (YX(1, 1), YX(2, 3), YX(7, 5)):
+            for start_indented in (True, False):
+                neighbors_i = geometry.get_neighbors_i(size, start_indented)
+                for y in range(size.y):
+                    for x in range(size.x):
+                        for d, direction in enumerate(geometry.directions):
+                            n = geometry.move(YX(YX(0, 0), YX(y, x)), direction,
+                                              size, start_indented)
+                            i = (y * size.x + x) * n_directions + d
+                            expected = -1 if n[0] != YX(0, 0) \
+                                else n[1].y * size.x + n[1].x
+                            self.assertEqual(neighbors_i[i], expected)
+        self.assertEqual(list(geometry.neighbors_i),
+                         [(YX(7, 5), True), (YX(7, 5), False)])
+
+
+class TestFovMapHex(unittest.TestCase):
+
+    def assert_fov(self, start_indented, rows):
+        """Assert FOV of (terrain line, expected FOV line) rows from center."""
+        size = YX(len(rows), len(rows[0][0]))
+        source_map = Map(size, start_indented=start_indented)
+        for y, (terrain_line, _) in enumerate(rows):
+            source_map.set_line(y, terrain_line)
+        fov_map = FovMapHex(source_map, YX(size.y // 2, size.x // 2))
+        self.assertEqual([line for _, line in fov_map.lines()],
+                         [fov_line for _, fov_line in rows])
+
+    def test_golden(self):
+        # Expected FOVs as calculated by the earlier float-based FovMapHex.
+        self.assert_fov(True, [
+            ('... .. ..', '???....??'),
+            ('.   ... .', '??......?'),
+            ('......   ', '?......??'),
+            ('  ..... .', '???.....?'),
+            ('. .  . ..', '???....??'),
+            ('.........', '???......'),
+            ('.  ... ..', '??......?'),
+            ('.  ... ..', '??.....??'),
+            ('........ ', '??....???')])
+
+        self.assert_fov(False, [
+            ('. .......... .  .', '??????...????????'),
+            ('  ...... . ... ..', '??????..?????????'),
+            ('.  ...... ... ...', '???????..????????'),
+            ('...  ...... .....', '??????..?????????'),
+            (' .. ........ ....', '???????..????????'),
+            ('.... ..... .. ...', '???????.????..???'),
+            ('. . ... ...... ..', '???????..??....??'),
+            ('.....  . ... . ..', '??????.......????'),
+            ('. ..... .. ..... ', '???????....??????'),
+            ('...  .. .... ....', '???????......????'),
+            ('.. ....... ..... ', '????????........?'),
+            ('  .............. ', '????????...?...??'),
+            (' ........ .......', '????????....??.??'),
+            ('. ... ....  .. ..', '????????....?????'),
+            ('......... . .....', '????????...??????'),
+            ('... .... ...  . .', '????????.?.??????'),
+            ('..... . .........', '???????????.?????')])
+
+        self.assert_fov(True, [
+            (' ........ ... ...', '????..???..??????'),
+            ('....... ... .....', '????...??..??????'),
+            ('........ .. .. . ', '???....?..???.???'),
+            ('.. ..... . ... ..', '???........??..??'),
+            ('....... ..  .....', '???.......?....??'),
+            ('............... .', '??..?.....?...???'),
+            (' .... ... .. ....', '?............????'),
+            ('   .........  ...', '??...............'),
+            ('..... .........  ', '?????...........?'),
+            ('.......... . ....', '?................'),
+            ('.... ....... . ..', '?..........??????'),
+            ('.    ... .... ...', '????........?????'),
+            ('. .  . .    ... .', '????........?????'),
+            ('.....   .... ....', '?????.?.?????????'),
+            ('. .. .... .......', '?????????????????'),
+            ('...... ..........', '?????????????????'),
+            ('.... .. .. ...  .', '?????????????????')])
+
+    def test_touching_cones(self):
+        # The earlier float-based FovMapHex saw into (1, 7) between two
+        # shadow cones that should touch, but due to rounding did not.
+        self.assert_fov(True, [
+            (' .. . ........... ...', '???????.?????????????'),
+            ('  . . .....  . . ....', '????????.????????????'),
+            ('. ... .....   ... .. ', '???????..??..????????'),
+            ('. ... ........  .... ', '????..??..?..????????'),
+            ('...... .. ..... . ...', '???....?..?.?????????'),
+            ('..  ......... ...... ', '???.....?....????????'),
+            ('. ........ ..........', '????....?...?????????'),
+            (' ........ ...  ......', '??????......?..??????'),
+            ('........... .. .. ...', '???????.......???????'),
+            ('.. .... ..... ..  ...', '?????????.....???????'),
+            ('. ..... . .. . .. ...', '?????????....????????'),
+            ('... ........ ....... ', '?????????....????????'),
+            ('........ ..   .. ....', '????????....?????????'),
+            ('...... .. .. .... ...', '?????????...?????????'),
+            ('.  .........  ...  ..', '?????????...?????????'),
+            ('..  . .. .... ... ...', '?????????....????????'),
+            (' . ........  .  .   .', '????????....?????????'),
+            ('... ...   ... .......', '????????....?????????'),
+            (' . .. ...... ...... .', '?????????...?????????'),
+            ('.  ....... ....... ..', '?????????...?????????'),
+            ('. ...  .. . . ... ...', '?????????...?????????')])
@@ -0,0 +1,197 @@
+import inspect
+import os
+import tempfile
+import time
+import unittest
+from plomrogue.errors import ArgError, GameError
+from plomrogue.misc import quote
+from plomrogue import snapshot
+
+
+
+class Replay:
+    """Replay game file lines into a game, as fast as possible.
+
+    Unlike GameIO.handle_input(), this neither stores lines in the
+    journal nor echoes them, and each distinct line is only parsed
+    once: the command it calls and its arguments are cached, as is,
+    per command function, whether it wants a connection_id (always
+    None here).
+    Replies are only queued if the game has clients to send them to,
+    which it usually does not yet. Errors are printed with the number
+    of the line causing them.
+
+    """
+
+    def __init__(self, game):
+        self.game = game
+        self.parsed = {}
+        self.wants_connection_id = {}
+        self.n_lines = 0
+        self.n_errors = 0
+        self.time = 0
+
+    def parse(self, line):
+        """Return command and args tuple for line, from cache if possible."""
+        if line not in self.parsed:
+            command, args = self.game.io.parser.parse(line)
+            wants_connection_id = False
+            if command is not None:
+                # Commands come as new partials of few distinct functions.
+                func = getattr(command, 'func', command)
+                if func not in self.wants_connection_id:
+                    parameters = inspect.signature(command).parameters
+                    self.wants_connection_id[func] = \
+                        'connection_id' in parameters
+                wants_connection_id = self.wants_connection_id[func]
+            self.parsed[line] = (command, wants_connection_id, tuple(args))
+        return self.parsed[line]
+
+    def run(self, lines, to_turn=None, to_line=None):
+        """Replay lines, stop before line number to_line or at turn to_turn.
+
+        Returns the number of the line replay stopped before.
+
+        """
+        start = time.perf_counter()
+        game = self.game
+        i = 0
+        for i, line in enumerate(lines):
+            if to_line is not None and i >= to_line:
+                break
+            if to_turn is not None and game.turn >= to_turn:
+                break
+            try:
+                command, wants_connection_id, args = self.parse(line)
+                if command is None:
+                    if line.strip() != '':
+                        raise ArgError('Unhandled input.')
+                    continue
+                # Commands may keep list arguments, so don't share them.
+                args = [list(arg) if type(arg) == list else arg
+                        for arg in args]
+                if wants_connection_id:
+                    command(*args, connection_id=None)
+                else:
+                    command(*args)
+            except (ArgError, GameError) as e:
+                self.n_errors += 1
+                print('REPLAY_ERROR %s %s' % (i, quote(str(e))))
+        else:
+            i = len(lines)
+        self.n_lines += i
+        self.time += time.perf_counter() - start
+        return i
+
+    def run_file(self, file_name, to_turn=None, to_line=None):
+        """run() lines of file_name, read all at once."""
+        with open(file_name) as f:
+            lines = f.readlines()
+        return self.run(lines, to_turn, to_line)
+
+    def get_stats(self):
+        """Return 'REPLAY_STATS' message on lines replayed so far.
+
+        Its fields are the number of lines replayed, of errors, the
+        time spent in milliseconds, and the lines replayed per second.
+
+        """
+        per_second = 0 if self.time == 0 else self.n_lines / self.time
+        return 'REPLAY_STATS %s %s %d %d' % (self.n_lines, self.n_errors,
+                                             self.time * 1e3, per_second)
+
+
+def get_restorer(game, turn):
+    """Return function restoring latest indexed state of game up to turn.
+
+    The state is restored from the game journal's history (see
+    Journal.get_checkpoint()): the last snapshot indexed before it
+    is loaded, and only what follows is replayed. The files needed
+    are opened right away, so the function returned, which does the
+    actual work, can be called outside the game loop even while the
+    history is trimmed. It returns a new game, which is not meant to
+    be played on, and the Replay used.
+
+    """
+    journal = game.io.journal
+    _, snapshot_file_name, start, end = journal.get_checkpoint(turn)
+    snapshot_file = None
+    if snapshot_file_name is not None:
+        snapshot_file = open(snapshot_file_name, 'rb')
+    history_file = open(journal.history_file_name, 'rb')
+    history_file.seek(start - journal.get_history_start())
+
+    def restore():
+        with history_file:
+            lines = history_file.read(end - start).decode().splitlines(True)
+        restored = type(game)(game.io.game_file_name)
+        restored.io.journal = None
+        if snapshot_file is not None:
+            with snapshot_file:
+                snapshot.load(restored, snapshot_file.read())
+        replay = Replay(restored)
+        replay.run(lines)
+        return restored, replay
+
+    return restore
+
+
+def restore(game, turn):
+    """Return get_restorer(game, turn)() right away."""
+    return get_restorer(game, turn)()
+
+
+
+class TestReplay(unittest.TestCase):
+
+    def test_run(self):
+        from plomrogue.game import Game
+        with tempfile.TemporaryDirectory() as dir_name:
+            file_name = os.path.join(dir_name, 'game')
+            game = Game(file_name)
+            game.io.handle_input('GEN_WORLD Y:8,X:8 3')
+            for i in range(5):
+                game.io.handle_input('TASK:WAIT')
+            game.io.handle_input('THING_INVENTORY 0 1')
+            game.io.journal.close()
+            with open(file_name, 'a') as f:
+                f.write('FOO\n')
+            game_2 = Game(file_name)
+            replay = Replay(game_2)
+            self.assertEqual(replay.run_file(file_name, to_turn=6), 3)
+            self.assertEqual(game_2.turn, 6)
+            self.assertEqual(replay.run_file(file_name, to_line=2), 2)
+            self.assertEqual(replay.run_file(file_name), 8)
+            self.assertEqual(game_2.get_save_lines(), game.get_save_lines())
+            self.assertIsNot(game_2.player.inventory,
+                             replay.parse('THING_INVENTORY 0 1')[2][1])
+            self.assertEqual(replay.get_stats().split()[1:3], ['13', '1'])
+
+    def test_restore(self):
+        from plomrogue.game import Game
+        with tempfile.TemporaryDirectory() as dir_name:
+            game = Game(os.path.join(dir_name, 'game'))
+            game.io.handle_input('GEN_WORLD Y:8,X:8 3')
+            saves = {}
+            for i in range(5):
+                if i == 3:
+                    game.io.compact()
+                game.io.handle_input('TASK:WAIT')
+                saves[game.turn] = game.get_save_lines()
+            restored, replay = restore(game, 13)
+            self.assertEqual(restored.get_save_lines(), saves[12])
+            self.assertEqual(replay.n_lines, 1)
+            restored, replay = restore(game, 4)
+            self.assertEqual(restored.get_save_lines(), saves[3])
+            self.assertEqual(replay.n_lines, 2)
+            game.io.handle_input('REPLAY_TO 6')
+            with open(game.io.game_file_name + '.turn_6.save') as f:
+                self.assertEqual(f.read().splitlines(), saves[6])
+            game.io.snapshots_kept = 1
+            game.io.compact()
+            self.assertFalse(os.path.exists(game.io.game_file_name +
+                                            '.snapshot.1'))
+            self.assertRaises(ArgError, restore, game, 12)
+            restored, replay = restore(game, 15)
+            self.assertEqual(restored.get_save_lines(), saves[15])
+            self.assertEqual(replay.n_lines, 0)
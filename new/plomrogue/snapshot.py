@@ -0,0 +1,298 @@
+import array
+import os
+import struct
+import sys
+import tempfile
+import unittest
+from plomrogue.errors import ArgError
+from plomrogue.mapping import Map, YX
+
+
+
+MAGIC = b'PLOMSNAP'
+VERSION = 1
+header_format = struct.Struct('<8sHqiiqIII')
+string_length_format = struct.Struct('<I')
+entity_columns = ('id', 'type', 'big_y', 'big_x', 'small_y', 'small_x',
+                  'health', 'n_inventory', 'task', 'task_todo', 'task_args')
+
+
+
+def _pack_array(typecode, values):
+    a = array.array(typecode, values)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a.tobytes()
+
+
+def _unpack_array(typecode, data, pos, n):
+    a = array.array(typecode)
+    end = pos + n * a.itemsize
+    if end > len(data):
+        raise ArgError('Snapshot data truncated.')
+    a.frombytes(data[pos:end])
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a, end
+
+
+def dump(state):
+    """Return binary snapshot of game state captured as a SaveState.
+
+    As only state is read (see Game.get_save_state()), this may run
+    outside the game loop. All integers are little-endian. After a
+    header (magic bytes, format version, turn, map size, player ID,
+    and the numbers of strings, maps and things) come a table of
+    length-prefixed UTF-8 strings (the random seed's decimal digits
+    first, then all thing type names, task names and task argument
+    strings referenced below), a directory of the maps' positions as
+    int32 y/x pairs, the maps' raw terrain bytes in directory order,
+    and finally the things in world order as columns of int64 values
+    (see entity_columns; -1 for no health or no task), followed by
+    the concatenated inventories' thing IDs.
+
+    """
+    strings = {str(state.seed): 0}
+
+    def string_id(string):
+        return strings.setdefault(string, len(strings))
+
+    columns = {name: [] for name in entity_columns}
+    inventories = []
+    for id_, type_, position, health, inventory, task in state.things:
+        columns['id'] += [id_]
+        columns['type'] += [string_id(type_)]
+        columns['big_y'] += [position[0].y]
+        columns['big_x'] += [position[0].x]
+        columns['small_y'] += [position[1].y]
+        columns['small_x'] += [position[1].x]
+        columns['health'] += [-1 if health is None else health]
+        columns['n_inventory'] += [len(inventory)]
+        inventories += inventory
+        if task is None:
+            columns['task'] += [-1]
+            columns['task_todo'] += [0]
+            columns['task_args'] += [-1]
+        else:
+            task_name, todo, task_args = task
+            columns['task'] += [string_id(task_name)]
+            columns['task_todo'] += [todo]
+            columns['task_args'] += [string_id(task_args)]
+    parts = [header_format.pack(MAGIC, VERSION, state.turn,
+                                state.map_size.y, state.map_size.x,
+                                state.player_id, len(strings),
+                                len(state.terrains), len(state.things))]
+    for string in strings:
+        encoded = string.encode()
+        parts += [string_length_format.pack(len(encoded)), encoded]
+    map_positions = []
+    for map_pos, _ in state.terrains:
+        map_positions += [map_pos.y, map_pos.x]
+    parts += [_pack_array('i', map_positions)]
+    parts += [terrain for _, terrain in state.terrains]
+    for name in entity_columns:
+        parts += [_pack_array('q', columns[name])]
+    parts += [_pack_array('q', inventories)]
+    return b''.join(parts)
+
+
+def load(game, data):
+    """Replace game's world state with that of snapshot data, see dump().
+
+    data may be bytes or anything else supporting the buffer
+    protocol, such as an mmap. Things of type names unknown to game
+    become of game.thing_type. Raises ArgError on data that is
+    truncated or otherwise corrupt.
+
+    """
+    data = memoryview(data)
+    if len(data) < header_format.size:
+        raise ArgError('Snapshot data truncated.')
+    magic, version, turn, map_size_y, map_size_x, player_id, n_strings, \
+        n_maps, n_things = header_format.unpack_from(data)
+    if magic != MAGIC:
+        raise ArgError('Not a snapshot.')
+    if version != VERSION:
+        raise ArgError('Unknown snapshot version: %s' % version)
+    pos = header_format.size
+    strings = []
+    for i in range(n_strings):
+        if pos + string_length_format.size > len(data):
+            raise ArgError('Snapshot data truncated.')
+        length, = string_length_format.unpack_from(data, pos)
+        pos += string_length_format.size
+        if pos + length > len(data):
+            raise ArgError('Snapshot data truncated.')
+        try:
+            strings += [bytes(data[pos:pos + length]).decode()]
+        except UnicodeDecodeError:
+            raise ArgError('Snapshot data corrupt.')
+        pos += length
+    map_positions, pos = _unpack_array('i', data, pos, 2 * n_maps)
+    map_size = YX(map_size_y, map_size_x)
+    map_size_i = map_size.y * map_size.x
+    if pos + n_maps * map_size_i > len(data):
+        raise ArgError('Snapshot data truncated.')
+    maps = {}
+    for i in range(n_maps):
+        map_ = Map(map_size)
+        map_.terrain = bytearray(data[pos:pos + map_size_i])
+        maps[YX(map_positions[2 * i], map_positions[2 * i + 1])] = map_
+        pos += map_size_i
+    columns = {}
+    for name in entity_columns:
+        columns[name], pos = _unpack_array('q', data, pos, n_things)
+    inventories, pos = _unpack_array('q', data, pos,
+                                     sum(columns['n_inventory']))
+
+    def get_string(i):
+        if not 0 <= i < len(strings):
+            raise ArgError('Snapshot data corrupt.')
+        return strings[i]
+
+    # Resolve all references before touching game, so that corrupt data
+    # leaves it as it was.
+    parser = game.io.parser
+    tasks = {-1: None}
+    try:
+        seed = int(get_string(0))
+        thing_classes = [game.thing_types.get(get_string(type_),
+                                              game.thing_type)
+                         for type_ in columns['type']]
+        for task, task_args in zip(columns['task'], columns['task_args']):
+            if task != -1 and (task, task_args) not in tasks:
+                task_class = game.tasks[get_string(task)]
+                args = parser.argsparse(task_class.argtypes,
+                                        parser.tokenize(get_string(task_args)))
+                tasks[(task, task_args)] = (task_class, tuple(args))
+    except (KeyError, ValueError):
+        raise ArgError('Snapshot data corrupt.')
+    game.things = []
+    game.turn = turn
+    game.rand.seed(seed)
+    game.map_size = map_size
+    game.maps = maps
+    game.flow_fields = {}
+    game.spawn_cells = {}
+    game.player_id = player_id
+    things = []
+    carried = set()
+    inventory_start = 0
+    for id_, thing_class, big_y, big_x, small_y, small_x, health, \
+            n_inventory, task, task_todo, task_args in \
+            zip(columns['id'], thing_classes,
+                *[columns[name] for name in entity_columns[2:]]):
+        position = (YX(big_y, big_x), YX(small_y, small_x))
+        thing = thing_class(game, id_, position)
+        if health >= 0:
+            thing.health = health
+        inventory_end = inventory_start + n_inventory
+        thing.inventory = list(inventories[inventory_start:inventory_end])
+        carried.update(thing.inventory)
+        inventory_start = inventory_end
+        task = tasks[-1 if task == -1 else (task, task_args)]
+        if task is not None:
+            thing.task = task[0](thing, task[1])
+            thing.task.todo = task_todo
+        elif hasattr(thing, 'task'):
+            thing.task = None
+        things += [thing]
+    for thing in things:
+        if thing.id_ in carried:
+            thing.in_inventory = True
+    game.things = things
+    player = game.get_thing(player_id, False)
+    game.player_is_alive = getattr(player, 'health', 1) > 0
+
+
+def read(game, file_name):
+    """load() snapshot from file_name into game in a single bulk read.
+
+    Raises ArgError if the file is missing or unreadable.
+
+    """
+    try:
+        with open(file_name, 'rb') as f:
+            data = f.read()
+    except OSError as e:
+        raise ArgError('Cannot read snapshot file %s: %s' %
+                       (file_name, e.strerror))
+    load(game, data)
+
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def test_roundtrip(self):
+        from plomrogue.game import Game
+        with tempfile.TemporaryDirectory() as dir_name:
+            game = Game(os.path.join(dir_name, 'game'))
+            game.io.handle_input('GEN_WORLD Y:8,X:8 3', store=False)
+            game.get_map(YX(1, -1))
+            player = game.player
+            food = [t for t in game.things if t.type_ == 'food'][0]
+            player.inventory = [food.id_]
+            food.in_inventory = True
+            player.task = game.tasks['MOVE'](player, ('LEFT',))
+            player.task.todo = 2
+            game.things[1].task = None
+            game.rand.seed(2**70)
+            data = dump(game.get_save_state())
+            game_2 = Game(os.path.join(dir_name, 'game_2'))
+            load(game_2, data)
+            self.assertEqual(dump(game_2.get_save_state()), data)
+            self.assertEqual(game_2.get_save_lines(), game.get_save_lines())
+            self.assertEqual(list(game_2.maps), list(game.maps))
+            self.assertEqual([t.in_inventory for t in game_2.things],
+                             [t.in_inventory for t in game.things])
+            self.assertEqual(game_2.player.task.args, ('LEFT',))
+            self.assertIsNone(game_2.things[1].task)
+            with self.assertRaises(ArgError):
+                load(game_2, data[:-1])
+            with self.assertRaises(ArgError):
+                load(game_2, b'PLOMSNAQ' + data[8:])
+            game.io.handle_input('THING_HEALTH 50 3')
+            data = dump(game.get_save_state())
+            load(game_2, data)
+            self.assertEqual(game_2.get_thing(50).type_, '?')
+            self.assertEqual(game_2.get_thing(50).health, 3)
+            self.assertEqual(dump(game_2.get_save_state()), data)
+            n_things = len(game.things)
+            n_carried = sum([len(t.inventory) for t in game.things])
+            types = len(data) - 8 * (len(entity_columns) * n_things +
+                                     n_carried) + 8 * n_things
+            for corrupt in (data[:types] + b'\xff' * 8 + data[types + 8:],
+                            data.replace(b'MOVE', b'MUVE')):
+                with self.assertRaises(ArgError):
+                    load(game_2, corrupt)
+                self.assertEqual(dump(game_2.get_save_state()), data)
+            with self.assertRaisesRegex(ArgError, 'game.snapshot.9'):
+                read(game_2, os.path.join(dir_name, 'game.snapshot.9'))
+            self.assertEqual(dump(game_2.get_save_state()), data)
+
+    def test_compact(self):
+        from plomrogue.game import Game
+        with tempfile.TemporaryDirectory() as dir_name:
+            file_name = os.path.join(dir_name, 'game')
+            game = Game(file_name)
+            game.io.handle_input('GEN_WORLD Y:8,X:8 3')
+            game.io.compact()
+            game.io.handle_input('TURN 5')
+            game.io.compact()
+            game.io.handle_input('TURN 7')
+            game.io.journal.close()
+            self.assertEqual(sorted(os.listdir(dir_name)),
+                             ['game', 'game.history', 'game.index',
+                              'game.snapshot.1', 'game.snapshot.2'])
+            game_2 = Game(file_name)
+            with open(file_name) as f:
+                for line in f:
+                    game_2.io.handle_input(line, store=False)
+            self.assertEqual(dump(game_2.get_save_state()),
+                             dump(game.get_save_state()))
+            self.assertEqual(game_2.io.snapshot_number, 2)
+            game_2.io.queues_out = {'a': None}
+            game_2.io.handle_input('LOAD_SNAPSHOT game.snapshot.2', 'a')
+            self.assertEqual(game_2.io.pending_out[-1][1],
+                             b'GAME_ERROR "Snapshots can only be loaded '
+                             b'from the game file."$')
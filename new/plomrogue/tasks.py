@@ -47,9 +47,8 @@ class Task_MOVE(Task):
         test_pos = self.get_move_target()
         if self.thing.game.maps[test_pos[0]][test_pos[1]] != '.':
             raise GameError('%s would move into illegal terrain' % self.thing.id_)
-        for t in self.thing.game.things_at_pos(test_pos):
-            if t.blocking:
-                raise GameError('%s would move into other thing' % self.thing.id_)
+        if self.thing.game.blocking_thing_at(test_pos) is not None:
+            raise GameError('%s would move into other thing' % self.thing.id_)
 
     def do(self):
         self.thing.position = self.get_move_target()
@@ -71,6 +70,7 @@ class Task_PICKUP(Task):
         to_pick_up = self.thing.game.get_thing(self.args[0])
         self.thing.inventory += [self.args[0]]
         to_pick_up.in_inventory = True
+        self.thing.game.drop_flow_fields(to_pick_up.position)
         to_pick_up.position = self.thing.position
 
 
@@ -101,7 +101,8 @@ class Task_DROP(TaskOnInventoryItem):
         self._basic_inventory_item_check()
 
     def do(self):
-        self._eliminate_from_inventory()
+        dropped = self._eliminate_from_inventory()
+        self.thing.game.drop_flow_fields(dropped.position)
 
 
 
@@ -115,5 +116,6 @@ class Task_EAT(TaskOnInventoryItem):
 
     def do(self):
         to_eat = self._eliminate_from_inventory()
-        del self.thing.game.things[self.thing.game.things.index(to_eat)]
+        self.thing.game.remove_thing(to_eat)
+        self.thing.game.drop_flow_fields(to_eat.position)
         self.thing.health += 50
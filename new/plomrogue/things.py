@@ -1,5 +1,5 @@
 from plomrogue.errors import GameError
-from plomrogue.mapping import YX, Map, FovMapHex
+from plomrogue.mapping import YX, Map, FovMapHex, get_char_table
 
 
 
@@ -28,7 +28,9 @@ class ThingBase:
         subclasses.
 
         """
+        old_pos = getattr(self, '_position', None)
         self._position = pos
+        self.game.thing_moved(self, old_pos)
 
     @position.setter
     def position(self, pos):
@@ -111,63 +113,15 @@ class ThingAnimate(Thing):
         self._last_task_result = None
         self.unset_surroundings()
 
-    def move_on_dijkstra_map(self, own_pos, targets):
-        visible_map = self.get_visible_map()
-        dijkstra_map = Map(visible_map.size,
-                           start_indented=visible_map.start_indented)
-        n_max = 256
-        dijkstra_map.terrain = [n_max for i in range(dijkstra_map.size_i)]
-        for target in targets:
-            dijkstra_map[target] = 0
-        shrunk = True
-        get_neighbors = self.game.map_geometry.get_neighbors
-        while shrunk:
-            shrunk = False
-            for pos in dijkstra_map:
-                if visible_map[pos] != '.':
-                    continue
-                neighbors = get_neighbors((YX(0,0), pos), dijkstra_map.size,
-                                          dijkstra_map.start_indented)
-                for direction in neighbors:
-                    big_yx, small_yx = neighbors[direction]
-                    if big_yx == YX(0,0) and \
-                       dijkstra_map[small_yx] < dijkstra_map[pos] - 1:
-                        dijkstra_map[pos] = dijkstra_map[small_yx] + 1
-                        shrunk = True
-        #print('DEBUG DIJKSTRA ---------------------', self.id_, self.position)
-        #for y, line in dijkstra_map.lines():
-        #    line_to_print = []
-        #    for x in line:
-        #        line_to_print += ['%3s' % x]
-        #    print(' '.join(line_to_print))
-        neighbors = get_neighbors((YX(0,0), own_pos), dijkstra_map.size,
-                                  dijkstra_map.start_indented)
-        n = n_max
-        target_direction = None
-        for direction in sorted(neighbors.keys()):
-            big_yx, small_yx = neighbors[direction]
-            if big_yx == (0,0):
-                n_new = dijkstra_map[small_yx]
-                if n_new < n:
-                    n = n_new
-                    target_direction = direction
-        return target_direction
-
     #def hunt_player(self):
     #    visible_things = self.get_visible_things()
-    #    target = None
-    #    for t in visible_things:
-    #        if t.type_ == 'human':
-    #            target = t.position[1] - self.view_offset
-    #            break
-    #    if target is not None:
+    #    if 'human' not in [t.type_ for t in visible_things]:
+    #        return False
+    #    target_dir = self.game.get_flow_direction('human', self)
+    #    if target_dir is not None:
     #        try:
-    #            offset_self_pos = self.position[1] - self.view_offset
-    #            target_dir = self.move_on_dijkstra_map(offset_self_pos,
-    #                                                   [target])
-    #            if target_dir is not None:
-    #                self.set_task('MOVE', (target_dir,))
-    #                return True
+    #            self.set_task('MOVE', (target_dir,))
+    #            return True
     #        except GameError:
     #            pass
     #    return False
@@ -184,17 +138,9 @@ class ThingAnimate(Thing):
                 self.set_task('PICKUP', (id_,))
                 return True
         visible_things = self.get_visible_things()
-        food_targets = []
-        for t in visible_things:
-            if t.type_ == 'food':
-                food_targets += [self.game.map_geometry.pos_in_view(t.position,
-                                                                    self.view_offset,
-                                                                    self.game.map_size)]
-        offset_self_pos = self.game.map_geometry.pos_in_view(self.position,
-                                                             self.view_offset,
-                                                             self.game.map_size)
-        target_dir = self.move_on_dijkstra_map(offset_self_pos,
-                                               food_targets)
+        if 'food' not in [t.type_ for t in visible_things]:
+            return False
+        target_dir = self.game.get_flow_direction('food', self)
         if target_dir:
             try:
                 self.set_task('MOVE', (target_dir,))
@@ -210,8 +156,10 @@ class ThingAnimate(Thing):
 
     def set_task(self, task_name, args=()):
         task_class = self.game.tasks[task_name]
-        self.task = task_class(self, args)
-        self.task.check()  # will throw GameError if necessary
+        task = task_class(self, args)
+        task.check()  # will throw GameError if necessary
+        # Only set now, so a refused (and thus unsaved) task leaves no trace.
+        self.task = task
 
     def proceed(self, is_AI=True):
         """Further the thing in its tasks, decrease its health.
@@ -233,7 +181,7 @@ class ThingAnimate(Thing):
             if self is self.game.player:
                 self.game.player_is_alive = False
             else:
-                del self.game.things[self.game.things.index(self)]
+                self.game.remove_thing(self)
             return
         try:
             self.task.check()
@@ -277,49 +225,52 @@ class ThingAnimate(Thing):
         return self._surroundings
 
     def get_stencil(self):
+        """Return bitset of positions visible in .surroundings."""
         if self._stencil is not None:
             return self._stencil
         m = Map(self.surroundings.size, ' ', self.surroundings.start_indented)
-        for pos in self.surroundings:
-            if self.surroundings[pos] in {'.', '~'}:
-                m[pos] = '.'
+        see_through = get_char_table('.~', '.', ' ')
+        m.terrain = self.surroundings.terrain.translate(see_through)
         fov_center = YX((m.size.y) // 2, m.size.x // 2)
-        self._stencil = FovMapHex(m, fov_center)
+        self._stencil = FovMapHex(m, fov_center).get_bits('.')
         return self._stencil
 
     def get_visible_map(self):
-        stencil = self.get_stencil()
-        m = Map(self.surroundings.size, ' ', self.surroundings.start_indented)
-        for pos in m:
-            if stencil[pos] == '.':
-                m[pos] = self.surroundings[pos]
-        return m
+        return self.surroundings.masked(self.get_stencil())
 
     def get_visible_things(self):
         stencil = self.get_stencil()
         visible_things = []
-        for thing in self.game.things:
+        for thing in self.game.get_things_in_region(self.view_offset,
+                                                    self.surroundings.size):
             pos = self.game.map_geometry.pos_in_view(thing.position,
                                                      self.view_offset,
                                                      self.game.map_size)
-            if pos.y < 0 or pos.x < 0 or\
-               pos.y >= stencil.size.y or pos.x >= stencil.size.x:
-                continue
-            if (not thing.in_inventory) and stencil[pos] == '.':
+            if (not thing.in_inventory) and \
+               stencil >> self.surroundings.get_position_index(pos) & 1:
                 visible_things += [thing]
         return visible_things
 
     def get_pickable_items(self):
+        geometry = self.game.map_geometry
+        view = self.surroundings
+
+        def view_i(pos):
+            return view.get_position_index(geometry.pos_in_view(pos,
+                                                                self.view_offset,
+                                                                self.game.map_size))
+
+        own_i = view_i(self.position)
+        n_directions = len(geometry.directions)
+        neighbors_i = geometry.get_neighbors_i(view.size, view.start_indented)
+        reach = {own_i} | set(neighbors_i[own_i * n_directions:
+                                          (own_i + 1) * n_directions])
         pickable_ids = []
-        visible_things = self.get_visible_things()
-        neighbor_fields = self.game.map_geometry.get_neighbors(self.position,
-                                                               self.game.map_size)
-        for t in [t for t in visible_things
-                  if isinstance(t, ThingItem) and
-                  (t.position == self.position or
-                   t.position in neighbor_fields.values())]:
+        for t in [t for t in self.get_visible_things()
+                  if isinstance(t, ThingItem) and view_i(t.position) in reach]:
             pickable_ids += [t.id_]
-        return pickable_ids
+        # Chunk index order differs between a game and its reload.
+        return sorted(pickable_ids)
 
 
 